@@ -0,0 +1,162 @@
+''' Benchmark: class results extraction of the CSI exporter, multi pass dicts vs. single pass records
+
+Builds the results of a synthetic class and compares time, peak allocation (tracemalloc) and
+retained memory of the previous implementation and of CSIExport.generate_results_for_class.
+
+Run with the RotorHazard server directory in the Python path, for example:
+
+    PYTHONPATH=/path/to/RotorHazard/src/server python benchmarks/bench_class_results.py
+'''
+
+import gc
+import random
+import timeit
+import tracemalloc
+from types import SimpleNamespace
+from common import import_plugin_module
+
+
+
+def generate_results_for_class_multi_pass(rhapi, class_id):
+    # previous implementation, kept here as a reference
+    raceclass = rhapi.db.raceclass_by_id(class_id)
+    ranking = raceclass.ranking
+
+    rankpayload = dict()
+    if ranking != None:
+        if isinstance(ranking, bool) and ranking is False:
+            rankpayload = dict()
+        else:
+            meta = ranking["meta"]
+            method_label = meta["method_label"]
+            ranks = ranking["ranking"]
+            for rank in ranks:
+                rank_values = rank.copy()
+
+                pilot_id = rank_values.pop("pilot_id", None)
+                callsign = rank_values.pop("callsign", None)
+                position = rank_values.pop("position", None)
+
+                pilot = {
+                    "classid": class_id,
+                    "classname": raceclass.name,
+                    "pilot_id": pilot_id,
+                    "callsign": callsign,
+                    "position": position,
+                    "method_label": method_label,
+                }
+
+                rankpayload[pilot_id] = pilot
+
+        db = rhapi.db
+        fullresults = db.raceclass_results(class_id)
+        if fullresults is not None:
+            meta = fullresults["meta"]
+            leaderboards = ["by_consecutives", "by_race_time", "by_fastest_lap"]
+            for leaderboard in leaderboards:
+                if leaderboard in fullresults:
+                    for result in fullresults[leaderboard]:
+                        pilot_id = result["pilot_id"]
+                        if pilot_id in rankpayload:
+                            rankpayload[pilot_id]["consecutives"] = result["consecutives"]
+                            rankpayload[pilot_id]["fastest_lap"] = result["fastest_lap"]
+                            rankpayload[pilot_id]["fastest_lap_raw"] = result["fastest_lap_raw"]
+                        else:
+                            rank_values = result.copy()
+
+                            pilot_id = rank_values.pop("pilot_id", None)
+                            callsign = rank_values.pop("callsign", None)
+                            position = rank_values.pop("position", None)
+                            consecutives = rank_values.pop("consecutives", None)
+                            fastest_lap = rank_values.pop("fastest_lap", None)
+                            fastest_lap_raw = rank_values.pop("fastest_lap_raw", None)
+
+                            pilot = {
+                                "classid": class_id,
+                                "classname": raceclass.name,
+                                "pilot_id": pilot_id,
+                                "callsign": callsign,
+                                "position": position,
+                                "consecutives": consecutives,
+                                "fastest_lap": fastest_lap,
+                                "fastest_lap_raw": fastest_lap_raw,
+                            }
+
+                            rankpayload[pilot_id] = pilot
+
+    return rankpayload
+
+
+
+def result_entry(pilot_id, position):
+    # same fields of a RotorHazard class leaderboard entry
+    fastest_lap_raw = random.randint(9000, 20000)
+    return {
+        "pilot_id": pilot_id, "callsign": f"Pilot {pilot_id}", "team_name": "", "node": pilot_id % 8,
+        "position": position, "laps": 12, "starts": 4, "total_time": "2:10.000", "total_time_raw": 130000,
+        "total_time_laps": "2:00.000", "total_time_laps_raw": 120000, "last_lap": "0:10.000", "last_lap_raw": 10000,
+        "average_lap": "0:10.000", "average_lap_raw": 10000, "fastest_lap": f"0:{fastest_lap_raw/1000:06.3f}",
+        "fastest_lap_raw": fastest_lap_raw, "fastest_lap_source": {"round": 1, "heat": 2, "displayname": "Heat 2"},
+        "consecutives": "0:30.000", "consecutives_raw": 30000, "consecutives_base": 3,
+        "consecutives_source": {"round": 1, "heat": 2, "displayname": "Heat 2"}, "consecutive_lap_start": 2
+    }
+
+
+
+def synthetic_rhapi(number_of_pilots):
+    pilot_ids = list(range(1, number_of_pilots+1))
+    random.shuffle(pilot_ids)
+    # some pilots have results but are not ranked
+    ranked = pilot_ids[:int(number_of_pilots*0.9)]
+    ranking = {
+        "meta": {"method_label": "Brackets", "rank_fields": []},
+        "ranking": [{"pilot_id": pilot_id, "callsign": f"Pilot {pilot_id}", "team_name": "", "position": i+1, "result": ""}
+                    for i, pilot_id in enumerate(ranked)]
+    }
+    # every leaderboard holds its own copy of each entry, in a different order
+    entries = [result_entry(pilot_id, i+1) for i, pilot_id in enumerate(pilot_ids)]
+    results = {"meta": {"primary_leaderboard": "by_consecutives"}}
+    for leaderboard in ["by_consecutives", "by_race_time", "by_fastest_lap"]:
+        results[leaderboard] = [dict(entry) for entry in entries]
+        random.shuffle(entries)
+    raceclass = SimpleNamespace(id=1, name="Qualifier", ranking=ranking)
+    db = SimpleNamespace(raceclass_by_id=lambda class_id: raceclass, raceclass_results=lambda class_id: results)
+    return SimpleNamespace(db=db)
+
+
+
+def measure_memory(fn):
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, retained, peak
+
+
+
+def main():
+    module = import_plugin_module('csi_export.csi_export_impl')
+    repeat = 10
+
+    for number_of_pilots in [500, 2000]:
+        rhapi = synthetic_rhapi(number_of_pilots)
+        # only the extraction is exercised: skip the constructor, which sets up the cloud sync
+        csi_export = module.CSIExport.__new__(module.CSIExport)
+        csi_export._rhapi = rhapi
+
+        multi_pass = lambda: generate_results_for_class_multi_pass(rhapi, 1)
+        single_pass = lambda: csi_export.generate_results_for_class(1)
+
+        old_result, old_retained, old_peak = measure_memory(multi_pass)
+        new_result, new_retained, new_peak = measure_memory(single_pass)
+        assert old_result == {pilot_id: dict(pilot) for pilot_id, pilot in new_result.items()}
+
+        old = min(timeit.repeat(multi_pass, number=repeat, repeat=3)) / repeat
+        new = min(timeit.repeat(single_pass, number=repeat, repeat=3)) / repeat
+        print(f"{number_of_pilots} pilots: "
+              f"multi pass {old*1e3:.2f} ms, peak {old_peak/1024:.0f} KiB, retained {old_retained/1024:.0f} KiB | "
+              f"single pass {new*1e3:.2f} ms, peak {new_peak/1024:.0f} KiB, retained {new_retained/1024:.0f} KiB")
+
+if __name__ == '__main__':
+    main()
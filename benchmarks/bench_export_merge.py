@@ -0,0 +1,140 @@
+''' Benchmark: final leaderboard merge of the CSI exporter, nested scan vs. keyed merge
+
+Exports a synthetic multi-category event (qualifier, finals, small finals) and shows how the
+merge time grows with the number of pilots.
+
+Run with the RotorHazard server directory in the Python path, for example:
+
+    PYTHONPATH=/path/to/RotorHazard/src/server python benchmarks/bench_export_merge.py
+'''
+
+import copy
+import random
+import timeit
+from types import SimpleNamespace
+from common import import_plugin_module
+
+
+
+def format_time_to_str(milliseconds):
+    return f"{milliseconds/1000:.3f}"
+
+
+
+def merge_final_leaderboard_nested_scan(qualifier_leaderboard, final_class_leaderboard, small_final_class_leaderboard, small_finals_enabled):
+    # previous implementation, kept here as a reference
+    def sort_leaderboard(leaderboard):
+        leaderboard = list(leaderboard.values())
+        leaderboard_with_position = [x for x in leaderboard if x.get("position") is not None]
+        leaderboard_without_position = [x for x in leaderboard if x.get("position") is None]
+        for i, element in enumerate(leaderboard_without_position):
+            if not element.get("position"):
+                element["position"] = len(leaderboard_with_position)+i+1
+        return sorted(leaderboard_with_position, key=lambda x: x['position']) + leaderboard_without_position
+
+    qualifier_leaderboard_sorted = sort_leaderboard(qualifier_leaderboard)
+    final_class_leaderboard_sorted = sort_leaderboard(final_class_leaderboard)
+    small_final_class_leaderboard_sorted = sort_leaderboard(small_final_class_leaderboard)
+
+    position = 1
+    the_fastest_lap = float('+inf')
+    if small_finals_enabled:
+        final_leaderboard = final_class_leaderboard_sorted[:16] + small_final_class_leaderboard_sorted[2:]
+    else:
+        final_leaderboard = final_class_leaderboard_sorted[:16] + qualifier_leaderboard_sorted[16:]
+
+    for element in final_leaderboard:
+        element["position"] = position
+        element["the_fastest"] = 0
+        for qualifier_element in qualifier_leaderboard_sorted:
+            if qualifier_element["pilot_id"] == element["pilot_id"]:
+                element["qualifier_position"] = qualifier_element["position"]
+                element["tq"] = 1 if (qualifier_element["position"] == 1) else 0
+                element["consecutives"] = qualifier_element["consecutives"] if qualifier_element["consecutives"] else format_time_to_str(0)
+                if element["fastest_lap_raw"] == 0:
+                    element["fastest_lap_raw"] = qualifier_element["fastest_lap_raw"]
+                if element["fastest_lap_raw"] != 0 and qualifier_element["fastest_lap_raw"] != 0:
+                    element["fastest_lap_raw"] = min(element["fastest_lap_raw"], qualifier_element["fastest_lap_raw"])
+                if element["fastest_lap_raw"] != 0:
+                    the_fastest_lap = min(the_fastest_lap, element["fastest_lap_raw"])
+        if small_finals_enabled:
+            for small_final_element in small_final_class_leaderboard_sorted:
+                if small_final_element["pilot_id"] == element["pilot_id"]:
+                    if element["fastest_lap_raw"] == 0:
+                        element["fastest_lap_raw"] = small_final_element["fastest_lap_raw"]
+                    if element["fastest_lap_raw"] != 0 and small_final_element["fastest_lap_raw"] != 0:
+                        element["fastest_lap_raw"] = min(element["fastest_lap_raw"], small_final_element["fastest_lap_raw"])
+                    if element["fastest_lap_raw"] != 0:
+                        the_fastest_lap = min(the_fastest_lap, element["fastest_lap_raw"])
+        element["fastest_lap"] = format_time_to_str(element["fastest_lap_raw"])
+        position += 1
+
+    for element in final_leaderboard:
+        if element["fastest_lap_raw"] == the_fastest_lap:
+            element["the_fastest"] = 1
+            break
+
+    return final_leaderboard
+
+
+
+def class_leaderboard(class_id, pilot_ids, with_consecutives):
+    # same shape as CSIExport.generate_results_for_class: pilot_id -> result
+    leaderboard = dict()
+    for position, pilot_id in enumerate(pilot_ids, start=1):
+        fastest_lap_raw = random.choice([0, random.randint(9000, 20000)])
+        leaderboard[pilot_id] = {
+            "classid": class_id,
+            "classname": f"Class {class_id}",
+            "pilot_id": pilot_id,
+            "callsign": f"Pilot {pilot_id}",
+            # some pilots complete no laps and have no position
+            "position": position if random.random() > 0.02 else None,
+            "consecutives": format_time_to_str(3 * fastest_lap_raw) if with_consecutives and fastest_lap_raw else None,
+            "fastest_lap": format_time_to_str(fastest_lap_raw),
+            "fastest_lap_raw": fastest_lap_raw
+        }
+    return leaderboard
+
+
+
+def synthetic_event(number_of_pilots):
+    pilot_ids = list(range(1, number_of_pilots+1))
+    random.shuffle(pilot_ids)
+    qualifier = class_leaderboard(1, pilot_ids, True)
+    # finals: 14 qualified pilots + 2 from the small finals, small finals: everybody else
+    finals = class_leaderboard(2, pilot_ids[:16], False)
+    small_finals = class_leaderboard(3, pilot_ids[14:], False)
+    return qualifier, finals, small_finals
+
+
+
+def main():
+    module = import_plugin_module('csi_export.csi_export_impl')
+    # only the merge is exercised: skip the constructor, which sets up the cloud sync
+    csi_export = module.CSIExport.__new__(module.CSIExport)
+    csi_export._rhapi = SimpleNamespace(utils=SimpleNamespace(format_time_to_str=format_time_to_str))
+    repeat = 5
+
+    for number_of_pilots in [125, 250, 500, 1000]:
+        event = synthetic_event(number_of_pilots)
+
+        assert merge_final_leaderboard_nested_scan(*copy.deepcopy(event), True) == csi_export.merge_final_leaderboard(*copy.deepcopy(event), True)
+
+        # the merge updates its input, so every run gets its own copy, made outside the timed section
+        def timed(merge):
+            timings = []
+            for _ in range(repeat):
+                inputs = copy.deepcopy(event)
+                start = timeit.default_timer()
+                merge(*inputs, True)
+                timings.append(timeit.default_timer() - start)
+            return min(timings)
+
+        old = timed(merge_final_leaderboard_nested_scan)
+        new = timed(csi_export.merge_final_leaderboard)
+        print(f"{number_of_pilots} pilots: nested scan {old*1e3:.2f} ms ({old/number_of_pilots*1e6:.1f} us/pilot), "
+              f"keyed merge {new*1e3:.2f} ms ({new/number_of_pilots*1e6:.1f} us/pilot)")
+
+if __name__ == '__main__':
+    main()
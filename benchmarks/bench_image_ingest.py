@@ -0,0 +1,54 @@
+''' Benchmark: overlay weight of uploaded avatars, stored as is vs. normalized to WebP
+
+Requires Pillow. Run with the RotorHazard server directory in the Python path, for example:
+
+    PYTHONPATH=/path/to/RotorHazard/src/server python benchmarks/bench_image_ingest.py
+'''
+
+import io
+import time
+from PIL import Image, ImageFilter
+from common import import_plugin_module
+
+
+
+def synthetic_photo(width, height, image_format):
+    # noise blurred into a photo-like texture, so compression ratios are realistic
+    image = Image.effect_noise((width // 4, height // 4), 64).convert('RGB')
+    image = image.resize((width, height), Image.BICUBIC).filter(ImageFilter.GaussianBlur(2))
+    output = io.BytesIO()
+    image.save(output, image_format, quality=92)
+    return output.getvalue()
+
+
+
+def decode_time(data, repeat=5):
+    # what the browser source does on every scene: decode the full image
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with Image.open(io.BytesIO(data)) as image:
+            image.load()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+
+def main():
+    module = import_plugin_module('ddr_overlays.image_ingest')
+
+    for width, height, image_format in [(4000, 3000, 'JPEG'), (3000, 4000, 'PNG'), (1200, 1600, 'JPEG')]:
+        original = synthetic_photo(width, height, image_format)
+
+        start = time.perf_counter()
+        normalized = module.normalize_image(original, module.AVATAR_SIZE, crop=True)
+        ingest = time.perf_counter() - start
+
+        print(f"{width}x{height} {image_format}: "
+              f"{len(original)/1024:.0f} KiB -> {len(normalized)/1024:.0f} KiB ({len(original)/len(normalized):.0f}x), "
+              f"decode {decode_time(original)*1000:.1f} ms -> {decode_time(normalized)*1000:.1f} ms, "
+              f"ingest {ingest*1000:.0f} ms")
+
+if __name__ == '__main__':
+    main()
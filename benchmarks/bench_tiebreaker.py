@@ -0,0 +1,80 @@
+''' Micro-benchmark: tiebreak by qualifier list scan vs. qualifier rank index
+
+Run with the RotorHazard server directory in the Python path, for example:
+
+    PYTHONPATH=/path/to/RotorHazard/src/server python benchmarks/bench_tiebreaker.py
+'''
+
+import random
+import timeit
+from common import import_plugin_module
+
+
+
+def apply_tiebreaker_list_scan(leaderboard, qualifier, first_position, second_position):
+    # previous implementation, kept here as a reference
+    from_index = first_position-1
+    to_index = second_position
+    leaderboard_slice = leaderboard[from_index:to_index]
+    leaderboard_slice = sorted(leaderboard_slice, key=lambda x: qualifier.index(x['pilot_id']) if x else 1024)
+    for i in range(to_index-from_index):
+        leaderboard[from_index+i] = leaderboard_slice[i]
+        if leaderboard[from_index+i]:
+            leaderboard[from_index+i]['position'] = first_position+i
+
+
+
+def tiebreak_groups(number_of_pilots):
+    # double elimination groups as in fai64de: 9-12, 13-16, 17-24, 25-32, 33-48, 49-64, ...
+    groups = [(9, 12), (13, 16)]
+    size = 8
+    while groups[-1][1] < number_of_pilots:
+        start = groups[-1][1]+1
+        groups.append((start, start+size-1))
+        groups.append((start+size, start+2*size-1))
+        size *= 2
+    return groups
+
+
+
+def synthetic_event(number_of_pilots):
+    qualifier = list(range(1000, 1000+number_of_pilots))
+    random.shuffle(qualifier)
+    leaderboard = [{'pilot_id': pilot_id, 'position': i+1} for i, pilot_id in enumerate(qualifier)]
+    random.shuffle(leaderboard)
+    return qualifier, leaderboard
+
+
+
+def main():
+    module = import_plugin_module('class_rank_brackets.class_rank_brackets')
+    repeat = 2000
+
+    for number_of_pilots in [64, 128]:
+        qualifier, leaderboard = synthetic_event(number_of_pilots)
+        groups = tiebreak_groups(number_of_pilots)
+
+        def list_scan():
+            board = [dict(x) for x in leaderboard]
+            for first_position, second_position in groups:
+                apply_tiebreaker_list_scan(board, qualifier, first_position, second_position)
+            return board
+
+        def rank_index():
+            board = [dict(x) for x in leaderboard]
+            qualifier_rank = dict()
+            for i, pilot_id in enumerate(qualifier):
+                qualifier_rank.setdefault(pilot_id, i)
+            for first_position, second_position in groups:
+                module.apply_tiebreaker(board, qualifier_rank, first_position, second_position)
+            return board
+
+        assert list_scan() == rank_index()
+
+        old = min(timeit.repeat(list_scan, number=repeat, repeat=5)) / repeat
+        new = min(timeit.repeat(rank_index, number=repeat, repeat=5)) / repeat
+        print(f"{number_of_pilots} pilots, {len(groups)} tiebreak groups: "
+              f"list scan {old*1e6:.1f} us, rank index {new*1e6:.1f} us ({old/new:.1f}x)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+''' Helpers shared by the benchmarks '''
+
+import os
+import sys
+import types
+import importlib
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'custom_plugins', 'csi_toolkit')
+
+def import_plugin_module(name):
+    # register the plugin as a bare package, so its submodules can be imported
+    # without running the plugin initialization in csi_toolkit/__init__.py
+    if 'csi_toolkit' not in sys.modules:
+        package = types.ModuleType('csi_toolkit')
+        package.__path__ = [PLUGIN_DIR]
+        sys.modules['csi_toolkit'] = package
+    return importlib.import_module('csi_toolkit.' + name)
@@ -1,14 +1,20 @@
+import io
+import copy
 import logging
 import random
+import time
+import zipfile
 import RHUtils
 from eventmanager import Evt
 
 from Database import ProgramMethod
 from RHUI import UIField, UIFieldType, UIFieldSelectOption
 
-from flask import jsonify, request, templating
+from flask import jsonify, request, send_file, templating
 from flask.blueprints import Blueprint
 
+from .cache_bus                                   import bus
+from .bracket_metadata                            import initialize as bracket_metadata_initializer, get_bracket_metadata, LEGACY_FORMATS_BY_HEAT_COUNT, BRACKET_FORMATS
 from .class_rank_brackets.class_rank_brackets     import initialize as class_rank_brackets_initializer
 from .csi_export.csi_export                       import initialize as csi_export_initializer
 from .ddr_overlays.ddr_overlays                   import initialize as ddr_overlays_initializer
@@ -45,11 +51,151 @@ class ClassType:
 
 
 
+def assign_slots(rhapi, assignments):
+    # applica tutte le modifiche agli slot in un'unica transazione
+    # (slots_alter_fast non genera eventi: da usare solo su heat appena create)
+    if assignments:
+        rhapi.db.slots_alter_fast(assignments)
+
+
+
+def plan_event(eventName, pilots, freeHeatSize, qualHeatSize, finalType, numAdvance, finalHeatSeeded):
+    # pianifica l'intero evento in memoria (nessun accesso al database)
+    num_pilots = len(pilots)
+
+    # distribuzione casuale dei piloti nelle heat di prove libere
+    # TODO: evitare heat da 1 o 2 piloti "prelevando" piloti da altre heat piene
+    randomized_pilots = [pilot["id"] for pilot in pilots]
+    random.shuffle(randomized_pilots)
+    practice_heats = [randomized_pilots[i:i+freeHeatSize] for i in range(0, num_pilots, freeHeatSize)]
+
+    if finalType == 16:
+        # multigp16
+        final_generator = Generator.BRACKET_DOUBLE_ELIMINATION
+        final_generator_args = {
+            "standard": "multigp16",
+            "seed_offset": 1
+        }
+    else:
+        # ddr8de
+        final_generator = Generator.BRACKET_DOUBLE_ELIMINATION_8
+        final_generator_args = {
+            "race1_qualifiers": "1,8,4,5",
+            "race2_qualifiers": "2,7,3,6"
+        }
+    # due piloti provengono dalle finaline, gli altri sono qualificati alla finale
+    already_qualified = finalType - 2
+
+    return {
+        "practice_heats": practice_heats,
+        "qualifier_generator_args": {
+            "qualifiers_per_heat": qualHeatSize,
+            "total_pilots": num_pilots,
+            "seed_offset": 1,
+            "suffix": "Qualifier"
+        },
+        "final_generator": final_generator,
+        "final_generator_args": final_generator_args,
+        "already_qualified": already_qualified,
+        "small_final": num_pilots > finalType,
+        "small_final_generator_args": {
+            "advances_per_heat": numAdvance,
+            "qualifiers_per_heat": finalHeatSeeded,
+            "total_pilots": num_pilots - already_qualified,
+            "seed_offset": already_qualified + 1,
+            "suffix": "Main"
+        }
+    }
+
+
+
+def final_heat_name(name):
+    # "Race x: ..." / "Race x - ..." -> "Race x"
+    if '-' in name:
+        return name[:name.index('-')]
+    if ':' in name:
+        return name[:name.index(':')]
+    return name
+
+
+
+class PhaseTimer():
+    ''' Tempo trascorso per ogni fase, in millisecondi '''
+
+    def __init__(self):
+        self.timings = dict()
+        self._start = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.timings[phase] = round((now - self._start) * 1000, 1)
+        self._start = now
+
+
+
+### INDICE DEGLI EVENTI ###
+
+# indice in memoria: nome evento -> classi per tipo, tipo di finale, piloti qualificati
+# ricostruito solo quando un evento su classi o heat lo rende obsoleto
+bus.on(Evt.CLASS_ADD, 'events')
+bus.on(Evt.CLASS_DUPLICATE, 'events')
+bus.on(Evt.CLASS_ALTER, 'events')
+bus.on(Evt.CLASS_DELETE, 'events')
+bus.on(Evt.HEAT_ADD, 'events')
+bus.on(Evt.HEAT_DELETE, 'events')
+bus.on(Evt.HEAT_GENERATE, 'events')
+bus.on(Evt.DATABASE_RESET, 'events')
+
+def build_event_index(rhapi):
+    events = dict()
+    for raceclass in rhapi.db.raceclasses:
+        event_name = rhapi.db.raceclass_attribute_value(raceclass, "orchestrator_event_name")
+        class_type = rhapi.db.raceclass_attribute_value(raceclass, "orchestrator_class_type")
+        if event_name:
+            if not events.get(event_name):
+                events[event_name] = {
+                    "name": event_name,
+                    "classes": dict(),
+                    "bracket_type": 'none',
+                    "qualified_pilots": 0
+                }
+            events[event_name]["classes"][class_type] = {
+                "id": raceclass.id,
+                "name": raceclass.name
+            }
+            # tipo di finale: letto dai metadati della classe, salvati alla generazione
+            if class_type == ClassType.FINAL:
+                metadata = get_bracket_metadata(rhapi, raceclass)
+                if metadata:
+                    bracket_type = metadata["format"]
+                    qualified_pilots = metadata["qualified_pilots"]
+                else:
+                    # classi generate senza metadati: ricava il tipo dal numero di heat
+                    number_of_final_heats = len(rhapi.db.heats_by_class(raceclass.id))
+                    bracket_type = LEGACY_FORMATS_BY_HEAT_COUNT.get(number_of_final_heats, 'none')
+                    qualified_pilots = BRACKET_FORMATS.get(bracket_type, {}).get("pilots", 0)
+                events[event_name]["bracket_type"] = bracket_type
+                events[event_name]["qualified_pilots"] = qualified_pilots
+    return events
+
+def get_event_index(rhapi):
+    cache = bus.cache('events')
+    events = cache.get('index')
+    if events is None:
+        events = build_event_index(rhapi)
+        cache.set('index', events)
+    return events
+
+
+
 def initialize(rhapi):
+    bracket_metadata_initializer(rhapi)
     class_rank_brackets_initializer(rhapi)
-    csi_export_initializer(rhapi)
+    csi_export = csi_export_initializer(rhapi)
     ddr_overlays_initializer(rhapi)
     generator_8_pilots_de_initializer(rhapi)
+    bus.attach(rhapi)
+    rhapi.events.on(Evt.STARTUP, lambda args: get_event_index(rhapi))
 
     bp = Blueprint(
         'orchestrator',
@@ -66,6 +212,8 @@ def initialize(rhapi):
 
     @bp.route("/orchestrator/create_event", methods=["POST"])
     def create_event():
+        timer = PhaseTimer()
+
         ### LETTURA PARAMETRI + ERROR HANDLING ###
 
         if any(map(lambda x: x not in request.json, ["eventName", "pilots", "settings"])):
@@ -88,12 +236,11 @@ def initialize(rhapi):
                 "error": "invalid eventName"
             })
 
-        for raceclass in rhapi.db.raceclasses:
-            if rhapi.db.raceclass_attribute_value(raceclass, "orchestrator_event_name") == eventName:
-                return jsonify({
-                    "success": False,
-                    "error": "Esiste già un evento con questo nome"
-                })
+        if eventName in get_event_index(rhapi):
+            return jsonify({
+                "success": False,
+                "error": "Esiste già un evento con questo nome"
+            })
         
         if freeHeatSize not in [3, 4, 5, 6]:
             return jsonify({
@@ -131,6 +278,14 @@ def initialize(rhapi):
                 "error": "invalid finalHeatSeeded"
             })
 
+        timer.lap("validate")
+
+        ### PIANIFICAZIONE ###
+
+        # l'evento viene pianificato in memoria prima di qualsiasi scrittura sul database
+        plan = plan_event(eventName, pilots, freeHeatSize, qualHeatSize, finalType, numAdvance, finalHeatSeeded)
+        timer.lap("plan")
+
         ### PROVE LIBERE ###
 
         # creazione classe prove libere
@@ -148,33 +303,22 @@ def initialize(rhapi):
             "orchestrator_class_type": ClassType.FREE_PRACTICE
         })
 
-        # creazione heat prove libere
-        heats = []
-        num_pilots = len(pilots)
-        num_heats = (num_pilots + freeHeatSize - 1) // freeHeatSize  # divisione arrotondata in su
-        for i in range(num_heats):
-            heat_name = f"Heat {i+1}"
+        # creazione heat prove libere e assegnazione dei piloti (scrittura in blocco)
+        assignments = []
+        for i, heat_pilots in enumerate(plan["practice_heats"]):
             heat = rhapi.db.heat_add(
-                name = heat_name,
+                name = f"Heat {i+1}",
                 raceclass = free_practice_class.id
             )
-            heats.append(heat)
-
-        # assegna i piloti alle heat
-        randomized_pilots = pilots[::]
-        random.shuffle(randomized_pilots)
-        for i, pilot in enumerate(randomized_pilots):
-            # TODO: evitare heat da 1 o 2 piloti "prelevando" piloti da altre heat piene
-            heat_index = i // freeHeatSize
-            node_index = i % freeHeatSize  # posizioni 0..freeHeatSize-1
-
-            slots = rhapi.db.slots_by_heat(heats[heat_index].id)
-            slot = slots[node_index]
-
-            rhapi.db.slot_alter(slot.id,
-                method = ProgramMethod.ASSIGN,
-                pilot = pilot["id"]
-            )
+            slots = rhapi.db.slots_by_heat(heat.id)
+            for node_index, pilot_id in enumerate(heat_pilots):
+                assignments.append({
+                    "slot_id": slots[node_index].id,
+                    "method": ProgramMethod.ASSIGN,
+                    "pilot": pilot_id
+                })
+        assign_slots(rhapi, assignments)
+        timer.lap("practice")
 
         ### QUALIFICHE ###
 
@@ -182,10 +326,7 @@ def initialize(rhapi):
         qualifier_class = rhapi.heatgen.generate(Generator.RANKED_FILL, {
             "input_class": free_practice_class.id,
             "output_class": None,
-            "qualifiers_per_heat": qualHeatSize, 
-            "total_pilots": num_pilots,
-            "seed_offset": 1,
-            "suffix": "Qualifier"
+            **plan["qualifier_generator_args"]
         })
 
         # configurazione ranking
@@ -202,30 +343,16 @@ def initialize(rhapi):
                 "orchestrator_class_type": ClassType.QUALIFIER
             }
         )
+        timer.lap("qualifier")
 
         ### FINALI ###
 
         # creazione classe finali tramite generatore
-        if finalType == 16:
-            # multigp16
-            final_class = rhapi.heatgen.generate(Generator.BRACKET_DOUBLE_ELIMINATION, {
-                "input_class": qualifier_class,
-                "output_class": None,
-                "standard": "multigp16",
-                "seed_offset": 1
-            })
-        elif finalType == 8:
-            # ddr8de
-            final_class = rhapi.heatgen.generate(Generator.BRACKET_DOUBLE_ELIMINATION_8, {
-                "input_class": qualifier_class,
-                "output_class": None,
-                "race1_qualifiers": "1,8,4,5",
-                "race2_qualifiers": "2,7,3,6"
-            })
-        else:
-            pass
-        # due piloti provengono dalle finaline, gli altri sono qualificati alla finale
-        already_qualified = finalType - 2
+        final_class = rhapi.heatgen.generate(plan["final_generator"], {
+            "input_class": qualifier_class,
+            "output_class": None,
+            **plan["final_generator_args"]
+        })
 
         # configurazione ranking
         rhapi.db.raceclass_alter(final_class,
@@ -248,29 +375,22 @@ def initialize(rhapi):
             }
         )
 
-        # rinominazione heat finali (lascia solo "Race x")
+        # rinominazione heat finali (lascia solo "Race x"), una sola scrittura per heat
         heats = rhapi.db.heats_by_class(final_class)
         for heat in heats:
-            name = heat.name
-            if ':' in name:
-                new_name = name[:name.index(':')]
-                rhapi.db.heat_alter(heat.id, name=new_name)
-            if '-' in name:
-                new_name = name[:name.index('-')]
+            new_name = final_heat_name(heat.name)
+            if new_name != heat.name:
                 rhapi.db.heat_alter(heat.id, name=new_name)
+        timer.lap("final")
 
         ### FINALINE ###
 
-        if num_pilots > finalType:
+        if plan["small_final"]:
             # creazione classe finaline tramite generatore (funziona sia con multigp16 che ddr8de)
             small_final_class = rhapi.heatgen.generate(Generator.BUMP_UP, {
                 "input_class": qualifier_class,
                 "output_class": None,
-                "advances_per_heat": numAdvance,
-                "qualifiers_per_heat": finalHeatSeeded,
-                "total_pilots": num_pilots - already_qualified,
-                "seed_offset": already_qualified + 1,
-                "suffix": "Main"
+                **plan["small_final_generator_args"]
             })
 
             # configurazione ranking
@@ -288,67 +408,43 @@ def initialize(rhapi):
                 }
             )
 
-            # inserimento dei vincitori delle finaline nelle finali
-            heats = rhapi.db.heats_by_class(final_class)
+            # inserimento dei vincitori delle finaline nelle finali (scrittura in blocco)
+            already_qualified = plan["already_qualified"]
+            assignments = []
             for heat in heats:
                 slots = rhapi.db.slots_by_heat(heat.id)
                 for slot in slots:
-                    # vincitore finaline
-                    if slot.seed_rank == already_qualified+1:
-                        rhapi.db.slot_alter(slot.id,
-                            method = ProgramMethod.CLASS_RESULT,
-                            seed_raceclass_id = small_final_class,
-                            seed_rank = 1
-                        )
-                    # secondo classificato finaline
-                    if slot.seed_rank == already_qualified+2:
-                        rhapi.db.slot_alter(slot.id,
-                            method = ProgramMethod.CLASS_RESULT,
-                            seed_raceclass_id = small_final_class,
-                            seed_rank = 2
-                        )
-
+                    # vincitore finaline / secondo classificato finaline
+                    if slot.seed_rank in [already_qualified+1, already_qualified+2]:
+                        assignments.append({
+                            "slot_id": slot.id,
+                            "method": ProgramMethod.CLASS_RESULT,
+                            "seed_raceclass_id": small_final_class,
+                            "seed_rank": slot.seed_rank - already_qualified
+                        })
+            assign_slots(rhapi, assignments)
+            timer.lap("small_final")
+
+        # un solo aggiornamento dei client a fine pipeline
         rhapi.ui.broadcast_raceclasses()
         rhapi.ui.broadcast_heats()
+        timer.lap("broadcast")
 
         return jsonify({
             "success": True,
-            "data": dict()
+            "data": {
+                "timings": timer.timings
+            }
         })
 
     @bp.route("/orchestrator/get_events")
     def get_events():
-        events = dict()
-        for raceclass in rhapi.db.raceclasses:
-            event_name = rhapi.db.raceclass_attribute_value(raceclass, "orchestrator_event_name")
-            class_type = rhapi.db.raceclass_attribute_value(raceclass, "orchestrator_class_type")
-            if event_name:
-                if not events.get(event_name):
-                    events[event_name] = {
-                        "name": event_name,
-                        "classes": dict(),
-                        "bracket_type": 'none'
-                    }
-                events[event_name]["classes"][class_type] = {
-                    "id": raceclass.id,
-                    "name": raceclass.name
-                }
-                # ricava il tipo di finale
-                if class_type == ClassType.FINAL:
-                    number_of_final_heats = len(rhapi.db.heats_by_class(raceclass.id))
-                    if number_of_final_heats == 14:
-                        events[event_name]["bracket_type"] = 'multigp16'
-                    elif number_of_final_heats == 6:
-                        events[event_name]["bracket_type"] = 'ddr8de'
-                    else:
-                        events[event_name]["bracket_type"] = 'none'
-
         result = []
-        for event_name in events:
+        for event in get_event_index(rhapi).values():
             this_event = {
-                "name": event_name,
-                "bracket_type": events[event_name].pop("bracket_type"),
-                "classes": events[event_name].pop("classes"),
+                "name": event["name"],
+                "bracket_type": event["bracket_type"],
+                "classes": copy.deepcopy(event["classes"]),
             }
             result.append(this_event)
 
@@ -358,32 +454,14 @@ def initialize(rhapi):
         })
 
     def get_event(eventName):
-        event = {
-            "name": eventName,
-            "classes": dict(),
-            "bracket_type": 'none'
-        }
-        for raceclass in rhapi.db.raceclasses:
-            event_name = rhapi.db.raceclass_attribute_value(raceclass, "orchestrator_event_name")
-            class_type = rhapi.db.raceclass_attribute_value(raceclass, "orchestrator_class_type")
-            if event_name == eventName:
-                event["classes"][class_type] = {
-                    "id": raceclass.id,
-                    "name": raceclass.name
-                }
-                # ricava il tipo di finale
-                if class_type == ClassType.FINAL:
-                    number_of_final_heats = len(rhapi.db.heats_by_class(raceclass.id))
-                    if number_of_final_heats == 14:
-                        event["bracket_type"] = 'multigp16'
-                        event["qualified_pilots"] = 16
-                    elif number_of_final_heats == 6:
-                        event["bracket_type"] = 'ddr8de'
-                        event["qualified_pilots"] = 8
-                    else:
-                        event["bracket_type"] = 'none'
-                        event["qualified_pilots"] = 0
-        return event
+        event = get_event_index(rhapi).get(eventName)
+        if not event:
+            return {
+                "name": eventName,
+                "classes": dict(),
+                "bracket_type": 'none'
+            }
+        return copy.deepcopy(event)
 
     @bp.route("/orchestrator/delete_event", methods=["POST"])
     def delete_event():
@@ -572,6 +650,16 @@ def initialize(rhapi):
             "data": dict()
         })
 
+    def export_event(event):
+        # classi dell'evento passate esplicitamente all'esportatore: nessuna opzione globale viene modificata,
+        # quindi più esportazioni possono essere eseguite contemporaneamente
+        small_final = event["classes"].get(ClassType.SMALL_FINAL)
+        return csi_export.export_event(
+            event["classes"][ClassType.QUALIFIER]["id"],
+            event["classes"][ClassType.FINAL]["id"],
+            small_final["id"] if small_final else None
+        )
+
     @bp.route("/orchestrator/export_results", methods=["POST"])
     def export_results():
         eventName = request.json.get("eventName")
@@ -582,27 +670,75 @@ def initialize(rhapi):
                 "error": "invalid eventName"
             })
 
-        # identifica classi dell'evento per configurare l'esportatore
-        rhapi.db.option_set('csi_small_final', '0')
         event = get_event(eventName)
-        for class_type in event["classes"]:
-            raceclass_id = event["classes"][class_type]["id"]
-            if class_type == ClassType.QUALIFIER:
-                rhapi.db.option_set('qualifier_class', raceclass_id)
-            elif class_type == ClassType.FINAL:
-                rhapi.db.option_set('final_class', raceclass_id)
-            elif class_type == ClassType.SMALL_FINAL:
-                rhapi.db.option_set('small_final_class', raceclass_id)
-                rhapi.db.option_set('csi_small_final', '1')
-                    
-        # lancia l'esportatore
-        result = rhapi.io.run_export("CSV_CSI_Upload")
+        if not event["classes"].get(ClassType.QUALIFIER) or not event["classes"].get(ClassType.FINAL):
+            return jsonify({
+                "success": False,
+                "error": f"L'evento {eventName} non ha qualifiche e finali"
+            })
+
+        # stesso formato dell'esportatore "CSV CSI Upload"
+        rows = export_event(event)
+        result = {
+            "data": ''.join(csi_export.iter_csv(rows)),
+            "encoding": "text/csv",
+            "ext": "csv"
+        }
 
         return jsonify({
             "success": True,
             "data": result
         })
 
+    @bp.route("/orchestrator/export_results_batch", methods=["POST"])
+    def export_results_batch():
+        eventNames = request.json.get("eventNames")
+
+        if not eventNames or not isinstance(eventNames, list):
+            return jsonify({
+                "success": False,
+                "error": "invalid eventNames"
+            })
+
+        # validazione: tutti gli eventi devono avere qualifiche e finali
+        events = []
+        # un evento ripetuto nella richiesta viene esportato una volta sola
+        for eventName in dict.fromkeys(eventNames):
+            event = get_event(eventName)
+            if not event["classes"].get(ClassType.QUALIFIER) or not event["classes"].get(ClassType.FINAL):
+                return jsonify({
+                    "success": False,
+                    "error": f"L'evento {eventName} non ha qualifiche e finali"
+                })
+            events.append(event)
+
+        # un file CSV per evento
+        output = io.BytesIO()
+        filenames = set()
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for event in events:
+                rows = export_event(event)
+                # nomi univoci nell'archivio: eventi diversi possono dare lo stesso nome di file (es. "a/b" e "a_b")
+                name = event["name"].replace('/', '_')
+                filename = f"Risultati Evento {name}.csv"
+                number = 2
+                while filename in filenames:
+                    filename = f"Risultati Evento {name} ({number}).csv"
+                    number += 1
+                filenames.add(filename)
+                archive.writestr(filename, ''.join(csi_export.iter_csv(rows)))
+        output.seek(0)
+
+        return send_file(output, mimetype='application/zip', as_attachment=True, download_name='Risultati Eventi.zip')
+
+    ### debug ###
+    @bp.route("/csi_toolkit/debug/caches")
+    def debug_caches():
+        return jsonify({
+            "success": True,
+            "data": bus.stats()
+        })
+
     rhapi.ui.blueprint_add(bp)
 
     rhapi.ui.register_panel("orchestrator", "CSI Toolkit Panel", "format")
@@ -0,0 +1,98 @@
+''' Bracket format metadata persisted on the generated class '''
+
+import os
+import json
+import logging
+from eventmanager import Evt
+from RHUI import UIField, UIFieldType
+
+logger = logging.getLogger(__name__)
+
+
+
+# raceclass attributes written when a bracket class is generated
+BRACKET_FORMAT = 'bracket_format'                     # format name, e.g. "multigp16"
+BRACKET_QUALIFIED_PILOTS = 'bracket_qualified_pilots'  # pilots entering the bracket
+BRACKET_HEATS = 'bracket_heats'                       # JSON list of heat ids, in bracket order
+
+BRACKET_FORMATS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ddr_overlays', 'static', 'data', 'bracket_formats.json')
+
+try:
+    with open(BRACKET_FORMATS_FILE, 'r') as file:
+        BRACKET_FORMATS = json.load(file)['formats']
+except Exception as e:
+    logger.error(f"Unable to load bracket formats from {BRACKET_FORMATS_FILE} ({e})")
+    BRACKET_FORMATS = dict()
+
+# heat count -> format, for classes generated before the metadata existed
+LEGACY_FORMATS_BY_HEAT_COUNT = {
+    14: 'multigp16',
+    6: 'ddr8de'
+}
+
+
+
+def format_of_generator(generator, generate_args):
+    # the regulation brackets of RotorHazard use the same names as the format registry
+    if generator in ["Regulation_bracket__double_elimination", "Regulation_bracket__single_elimination"]:
+        return (generate_args or {}).get("standard")
+    if generator == "_8_Pilot_Double_Elimination_Bracket":
+        return "ddr8de"
+    return None
+
+
+
+def store_bracket_metadata(rhapi, class_id, bracket_format):
+    heats = rhapi.db.heats_by_class(class_id)
+    rhapi.db.raceclass_alter(class_id, attributes = {
+        BRACKET_FORMAT: bracket_format,
+        BRACKET_QUALIFIED_PILOTS: str(BRACKET_FORMATS.get(bracket_format, {}).get('pilots', 0)),
+        BRACKET_HEATS: json.dumps([heat.id for heat in heats])
+    })
+
+
+
+def get_bracket_metadata(rhapi, raceclass):
+    ''' Returns {format, qualified_pilots, heats} or None if the class has no bracket metadata '''
+    bracket_format = rhapi.db.raceclass_attribute_value(raceclass, BRACKET_FORMAT)
+    if not bracket_format:
+        return None
+
+    try:
+        qualified_pilots = int(rhapi.db.raceclass_attribute_value(raceclass, BRACKET_QUALIFIED_PILOTS) or 0)
+        heats = json.loads(rhapi.db.raceclass_attribute_value(raceclass, BRACKET_HEATS) or '[]')
+    except ValueError as e:
+        logger.warning(f"Invalid bracket metadata in class {raceclass.id} ({e})")
+        return None
+
+    return {
+        'format': bracket_format,
+        'qualified_pilots': qualified_pilots,
+        'heats': heats
+    }
+
+
+
+def order_bracket_heats(heats, metadata):
+    # heats in bracket order; a heat removed from the class leaves a None, so numbering is preserved
+    if not metadata or not metadata['heats']:
+        return heats
+    heats_by_id = {heat.id: heat for heat in heats}
+    return [heats_by_id.get(heat_id) for heat_id in metadata['heats']]
+
+
+
+def heat_generate_listener(rhapi, args):
+    bracket_format = format_of_generator(args.get('generator'), args.get('generate_args'))
+    if bracket_format and args.get('output_class_id'):
+        store_bracket_metadata(rhapi, args['output_class_id'], bracket_format)
+
+def initialize(rhapi):
+    rhapi.fields.register_raceclass_attribute(UIField(BRACKET_FORMAT, "Bracket Format", UIFieldType.TEXT, value="", private=True))
+    rhapi.fields.register_raceclass_attribute(UIField(BRACKET_QUALIFIED_PILOTS, "Bracket Qualified Pilots", UIFieldType.TEXT, value="", private=True))
+    rhapi.fields.register_raceclass_attribute(UIField(BRACKET_HEATS, "Bracket Heats", UIFieldType.TEXT, value="", private=True))
+
+    def bracket_metadata_heat_generate(args):
+        heat_generate_listener(rhapi, args)
+    # synchronous, so the metadata is available as soon as the generator returns
+    rhapi.events.on(Evt.HEAT_GENERATE, bracket_metadata_heat_generate, priority = 20)
@@ -0,0 +1,197 @@
+''' Event-driven invalidation of CSI Toolkit caches '''
+
+import logging
+from collections import OrderedDict
+from eventmanager import Evt
+from RHUI import UIFieldSelectOption
+
+logger = logging.getLogger(__name__)
+
+
+
+class Cache():
+    ''' Named key/value cache with hit, miss and invalidation counters, optionally LRU bounded '''
+
+    def __init__(self, name, max_size=None):
+        self.name = name
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._generations = dict()  # key -> number of invalidations
+        self._epoch = 0             # number of full clears
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self.hits += 1
+            if self.max_size:
+                self._data.move_to_end(key)
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        self._data[key] = value
+        if self.max_size:
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def generation(self, key):
+        # changes every time the key is invalidated, to be used in fingerprints of derived data
+        return (self._epoch, self._generations.get(key, 0))
+
+    def invalidate(self, key):
+        self._generations[key] = self._generations.get(key, 0) + 1
+        self.invalidations += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._epoch += 1
+        self._generations.clear()
+        self.invalidations += 1
+        self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+            'invalidations': self.invalidations,
+            'evictions': self.evictions
+        }
+
+
+
+class CacheBus():
+    ''' Maps RotorHazard events to the cache keys they make dirty '''
+
+    # a dirty_fn returning ALL invalidates the whole cache
+    ALL = object()
+
+    def __init__(self):
+        self._caches = dict()
+        self._rules = dict()            # event -> list of (cache name, dirty_fn)
+        self._stats_providers = dict()  # name -> function returning a JSON serializable dict
+        self._rhapi = None
+        self._attached = set()
+        self.events = dict()            # event -> number of dispatches
+
+    def cache(self, name, max_size=None):
+        if name not in self._caches:
+            self._caches[name] = Cache(name, max_size)
+        elif max_size:
+            self._caches[name].max_size = max_size
+        return self._caches[name]
+
+    def on(self, event, cache_name, dirty_fn=None):
+        ''' dirty_fn(rhapi, args) returns the keys dirtied by the event, or ALL (default) '''
+        self.cache(cache_name)
+        self._rules.setdefault(event, []).append((cache_name, dirty_fn))
+        if self._rhapi:
+            self._listen(event)
+
+    def add_stats_provider(self, name, stats_fn):
+        self._stats_providers[name] = stats_fn
+
+    def attach(self, rhapi):
+        self._rhapi = rhapi
+        for event in self._rules:
+            self._listen(event)
+
+    def _listen(self, event):
+        if event in self._attached:
+            return
+        self._attached.add(event)
+
+        def handler(args):
+            self.dispatch(event, args)
+        # handlers are identified by name, give each event its own
+        handler.__name__ = f"csi_toolkit_cache_bus_{event}"
+
+        # synchronous priority, so caches are dirty before anybody else reacts to the event
+        self._rhapi.events.on(event, handler, priority = 10)
+
+    def dispatch(self, event, args):
+        self.events[event] = self.events.get(event, 0) + 1
+        for cache_name, dirty_fn in self._rules.get(event, []):
+            cache = self._caches[cache_name]
+            try:
+                keys = dirty_fn(self._rhapi, args) if dirty_fn else CacheBus.ALL
+            except Exception as e:
+                logger.warning(f"Unable to find keys dirtied by {event} in cache {cache_name} ({e}), clearing it")
+                keys = CacheBus.ALL
+
+            if keys is CacheBus.ALL:
+                cache.clear()
+            else:
+                for key in keys:
+                    cache.invalidate(key)
+
+    def stats(self):
+        stats = {
+            'caches': {name: cache.stats() for name, cache in self._caches.items()},
+            'events': dict(self.events)
+        }
+        for name, stats_fn in self._stats_providers.items():
+            stats[name] = stats_fn()
+        return stats
+
+bus = CacheBus()
+
+
+
+# Helpers to extract dirty keys from event arguments
+
+def class_of_race(rhapi, args):
+    race = rhapi.db.race_by_id(args['race_id'])
+    return [race.class_id] if race else []
+
+def race_of_event(rhapi, args):
+    return [args['race_id']]
+
+def class_of_event(rhapi, args):
+    return [args['class_id']]
+
+def class_of_heat(rhapi, args):
+    heat = rhapi.db.heat_by_id(args['heat_id'])
+    return [heat.class_id] if heat else CacheBus.ALL
+
+def output_class_of_generator(rhapi, args):
+    return [args['output_class_id']]
+
+
+
+# Class selector options shared by the plugins (rebuilt only when classes change)
+
+bus.on(Evt.CLASS_ADD, 'class_options')
+bus.on(Evt.CLASS_DUPLICATE, 'class_options')
+bus.on(Evt.CLASS_ALTER, 'class_options')
+bus.on(Evt.CLASS_DELETE, 'class_options')
+bus.on(Evt.DATABASE_RESET, 'class_options')
+
+def get_class_options(rhapi):
+    cache = bus.cache('class_options')
+    options = cache.get('options')
+    if options is None:
+        options = []
+        for this_class in rhapi.db.raceclasses:
+            if not this_class.name:
+                name = f"Class {this_class.id}"
+            else:
+                name = this_class.name
+            options.append(UIFieldSelectOption(this_class.id, name))
+        cache.set('options', options)
+    return options
@@ -1,11 +1,16 @@
 ''' Class ranking method: Brackets '''
 
+import os
+import json
 import logging
 import RHUtils
 from eventmanager import Evt
 from RHRace import StartBehavior
 from Results import RaceClassRankMethod
 from RHUI import UIField, UIFieldType, UIFieldSelectOption
+from ..debounce import debounced
+from ..bracket_metadata import get_bracket_metadata, order_bracket_heats
+from ..cache_bus import bus, get_class_options, race_of_event, class_of_race, class_of_event, class_of_heat, output_class_of_generator
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +29,193 @@ CSI = "CSI Drone Racing"
 
 
 
-def apply_tiebreaker(leaderboard, qualifier, first_position, second_position):
+# Bracket formats are described in a data file shared with the overlays.
+# Each ranking entry maps the positions from 5th place on to a (heat, place) pair of the bracket
+# and lists the groups of positions whose ties are solved using the qualifier class.
+BRACKET_FORMATS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ddr_overlays', 'static', 'data', 'bracket_formats.json')
+
+def load_ranking_formats(path):
+    with open(path, 'r') as file:
+        bracket_formats = json.load(file)
+
+    ranking_formats = dict()
+    for entry in bracket_formats['rankings']:
+        heat_names = entry.get('heat_names', {})
+        rows = []
+        for i, (heat_number, heat_position) in enumerate(entry['positions']):
+            heat_name = heat_names.get(str(heat_number), f"Heat {heat_number}")
+            rows.append((entry['first_position']+i, heat_number, heat_position, f"{heat_position}° in {heat_name}"))
+        compiled = {
+            'format': entry['format'],
+            'description': entry['description'],
+            'rows': rows,
+            'tiebreaks': [tuple(group) for group in entry['tiebreaks']]
+        }
+        for bracket_type in entry['bracket_types']:
+            ranking_formats[(bracket_type, entry['heat_count'])] = compiled
+    return ranking_formats
+
+try:
+    RANKING_FORMATS = load_ranking_formats(BRACKET_FORMATS_FILE)
+except Exception as e:
+    logger.error(f"Unable to load bracket formats from {BRACKET_FORMATS_FILE} ({e})")
+    RANKING_FORMATS = dict()
+
+# same entries, indexed by format name for classes carrying bracket metadata
+RANKING_FORMATS_BY_NAME = {(bracket_type, ranking_format['format']): ranking_format for (bracket_type, _), ranking_format in RANKING_FORMATS.items()}
+
+def get_ranking_format(bracket_type, number_of_heats, metadata=None):
+    if metadata:
+        ranking_format = RANKING_FORMATS_BY_NAME.get((bracket_type, metadata['format']))
+        if ranking_format:
+            return ranking_format
+    # classes generated without metadata, or ranked with another bracket type than the generated format
+    # (e.g. a MultiGP bracket ranked as FAI): detect the format from the number of heats
+    return RANKING_FORMATS.get((bracket_type, number_of_heats))
+
+
+
+####################################################################################################
+
+# The results of a saved race change only when the race is saved again, so the leaderboard of each
+# race is cached until the invalidation bus reports a LAPS_SAVE/LAPS_RESAVE for it.
+# Each ranking pass computes a fingerprint of its inputs (heat ids, race ids and cache generations):
+# if nothing changed the previous ranking is returned as is, otherwise only the races that have
+# been saved again are read from the database.
+# A changed fingerprint rebuilds the whole ranking from the cached race leaderboards and not only
+# the positions fed by the saved heat: ties are resolved across groups of positions and Chase the
+# Ace reads every round of the final, so a single heat can move positions it does not feed.
+# The qualifier leaderboard is frozen once the finals start, so it is cached per class as well
+# and it is read again only after a race of that class is saved or the class is altered.
+
+race_leaderboard_cache = bus.cache('race_leaderboards')  # race_id -> leaderboard
+qualifier_cache = bus.cache('qualifiers')                # class_id -> (qualifier, qualifier_rank)
+ranking_cache = bus.cache('rankings')                    # class_id -> (fingerprint, leaderboard, meta)
+
+for event in [Evt.LAPS_SAVE, Evt.LAPS_RESAVE]:
+    bus.on(event, 'race_leaderboards', race_of_event)
+    bus.on(event, 'qualifiers', class_of_race)
+    bus.on(event, 'rankings', class_of_race)
+bus.on(Evt.CLASS_ALTER, 'qualifiers', class_of_event)
+bus.on(Evt.CLASS_DELETE, 'qualifiers', class_of_event)
+bus.on(Evt.CLASS_DELETE, 'rankings', class_of_event)
+bus.on(Evt.HEAT_ADD, 'rankings', class_of_heat)
+bus.on(Evt.HEAT_ALTER, 'rankings', class_of_heat)
+bus.on(Evt.HEAT_DELETE, 'rankings')
+bus.on(Evt.HEAT_GENERATE, 'rankings', output_class_of_generator)
+# callsigns and team names are copied into the cached leaderboards, and race ids are reused after a reset
+for event in [Evt.PILOT_ALTER, Evt.ROUNDS_RESET, Evt.DATABASE_RESET]:
+    bus.on(event, 'race_leaderboards')
+    bus.on(event, 'rankings')
+for event in [Evt.ROUNDS_RESET, Evt.DATABASE_RESET]:
+    bus.on(event, 'qualifiers')
+
+def get_race_leaderboard(rhapi, race, heat_leaderboards=None):
+    leaderboard = race_leaderboard_cache.get(race.id)
+    if leaderboard is not None:
+        return leaderboard
+
+    if heat_leaderboards is not None:
+        heat_leaderboards.db_calls += 1
+    race_result = rhapi.db.race_results(race)
+    if not race_result:
+        return None
+
+    leaderboard = race_result[race_result['meta']['primary_leaderboard']]
+    race_leaderboard_cache.set(race.id, leaderboard)
+    return leaderboard
+
+
+
+class HeatLeaderboards():
+    ''' Round 1 leaderboards of all heats in a bracket class, indexed by heat number (1-based) '''
+
+    def __init__(self, heats):
+        self.heats = heats
+        self.races = dict()         # heat number -> races of the heat
+        self.leaderboards = dict()  # heat number -> leaderboard of Round 1
+        self.db_calls = 0
+        self.lookups = 0
+
+    def __len__(self):
+        return len(self.heats)
+
+    def get(self, heat_number):
+        self.lookups += 1
+        return self.leaderboards.get(heat_number)
+
+    @property
+    def db_calls_saved(self):
+        # without prefetch every lookup costs a races_by_heat and a race_results call
+        return 2 * self.lookups - self.db_calls
+
+
+
+def prefetch_heat_leaderboards(rhapi, heats):
+    heat_leaderboards = HeatLeaderboards(heats)
+    for heat_number, heat in enumerate(heats, start=1):
+        if not heat:
+            # heat removed from the bracket class
+            heat_leaderboards.races[heat_number] = []
+            continue
+        races = rhapi.db.races_by_heat(heat.id)
+        heat_leaderboards.db_calls += 1
+        heat_leaderboards.races[heat_number] = races
+        # for robustness, don't use heat_results but get results from Round 1 instead
+        if races:
+            leaderboard = get_race_leaderboard(rhapi, races[0], heat_leaderboards)
+            if leaderboard:
+                heat_leaderboards.leaderboards[heat_number] = leaderboard
+    return heat_leaderboards
+
+
+
+def get_qualifier(rhapi, qualifier_class_id):
+    cached = qualifier_cache.get(qualifier_class_id)
+    if cached:
+        return cached
+
+    raceclass = rhapi.db.raceclass_by_id(qualifier_class_id)
+    qualifier_result = rhapi.db.raceclass_results(raceclass) if raceclass else None
+    if not qualifier_result:
+        return None, None
+
+    qualifier = qualifier_result[qualifier_result['meta']['primary_leaderboard']]
+    # in general, leaderboards are already sorted by position, but sort them explicitly to be sure
+    # however consider that pilots could be without a value for the "position" field (for example if they do not complete any laps),
+    # handle this case by putting them at the end of the leaderboard
+    qualifier_with_position = [x for x in qualifier if x.get("position") is not None]
+    qualifier_without_position = [x for x in qualifier if x.get("position") is None]
+    for i, element in enumerate(qualifier_without_position):
+        if not element.get("position"):
+            element["position"] = len(qualifier_with_position)+i+1
+    # sort by position (to be safe) and extract only the pilot IDs
+    qualifier = list(map(lambda x: x['pilot_id'], sorted(qualifier_with_position, key=lambda x: x['position']) + qualifier_without_position))
+    logger.info(f"Found {len(qualifier)} pilots in the qualifier class")
+    # index of each pilot in the qualifier class, built once and used to resolve all ties
+    qualifier_rank = dict()
+    for i, pilot_id in enumerate(qualifier):
+        qualifier_rank.setdefault(pilot_id, i)
+
+    qualifier_cache.set(qualifier_class_id, (qualifier, qualifier_rank))
+    return qualifier, qualifier_rank
+
+
+
+def get_ranking_fingerprint(heat_leaderboards, args):
+    heat_fingerprints = []
+    for heat_number, heat in enumerate(heat_leaderboards.heats, start=1):
+        races = heat_leaderboards.races[heat_number]
+        heat_fingerprints.append((heat.id if heat else None, tuple((race.id, race_leaderboard_cache.generation(race.id)) for race in races)))
+
+    qualifier_class_id = int(args["qualifier_class"])
+    settings = tuple(sorted((key, str(value)) for key, value in args.items()))
+
+    return (settings, qualifier_class_id, qualifier_cache.generation(qualifier_class_id), tuple(heat_fingerprints))
+
+
+
+def apply_tiebreaker(leaderboard, qualifier_rank, first_position, second_position):
     # assume that first_position < second_position and they are 1-based
     from_index = first_position-1
     to_index = second_position
@@ -33,7 +224,7 @@ def apply_tiebreaker(leaderboard, qualifier, first_position, second_position):
     leaderboard_slice = leaderboard[from_index:to_index]
 
     # order them by position in qualifier class
-    leaderboard_slice = sorted(leaderboard_slice, key=lambda x: qualifier.index(x['pilot_id']) if x else 1024) # corner case for missing pilots
+    leaderboard_slice = sorted(leaderboard_slice, key=lambda x: qualifier_rank[x['pilot_id']] if x else 1024) # corner case for missing pilots
 
     for i in range(to_index-from_index):
         # update the order of pilots in the leaderboard
@@ -45,50 +236,10 @@ def apply_tiebreaker(leaderboard, qualifier, first_position, second_position):
 
 
 
-def apply_tiebreaker_generic(leaderboard, qualifier, number_of_heats, bracket_type):
-    if bracket_type == MULTIGP or bracket_type == CSI:
-        # no tiebreaker for ddr8de
-        if number_of_heats == 14:
-            # multigp16
-            apply_tiebreaker(leaderboard, qualifier, 9, 10)    # Q1
-            apply_tiebreaker(leaderboard, qualifier, 11, 12)   # Q2
-            apply_tiebreaker(leaderboard, qualifier, 13, 14)   # Q3
-            apply_tiebreaker(leaderboard, qualifier, 15, 16)   # Q4
-    elif bracket_type == FAI:
-        if number_of_heats == 6:
-            # ddr8de
-            apply_tiebreaker(leaderboard, qualifier, 5, 6)     # Q1
-            apply_tiebreaker(leaderboard, qualifier, 7, 8)     # Q2
-        elif number_of_heats == 8:
-            # fai16
-            apply_tiebreaker(leaderboard, qualifier, 9,  16)   # Q1
-        elif number_of_heats == 14:
-            # fai16de
-            apply_tiebreaker(leaderboard, qualifier, 9,  12)   # Q1
-            apply_tiebreaker(leaderboard, qualifier, 13, 16)   # Q2
-        elif number_of_heats == 16:
-            # fai32
-            apply_tiebreaker(leaderboard, qualifier, 9,  16)   # Q1
-            apply_tiebreaker(leaderboard, qualifier, 17, 32)   # Q2
-        elif number_of_heats == 30:
-            # fai32de
-            apply_tiebreaker(leaderboard, qualifier, 9,  12)   # Q1
-            apply_tiebreaker(leaderboard, qualifier, 13, 16)   # Q2
-            apply_tiebreaker(leaderboard, qualifier, 17, 24)   # Q3
-            apply_tiebreaker(leaderboard, qualifier, 25, 32)   # Q4
-        elif number_of_heats == 32:
-            # fai64
-            apply_tiebreaker(leaderboard, qualifier, 9,  16)   # Q1
-            apply_tiebreaker(leaderboard, qualifier, 17, 32)   # Q2
-            apply_tiebreaker(leaderboard, qualifier, 33, 64)   # Q3
-        elif number_of_heats == 62:
-            # fai64de
-            apply_tiebreaker(leaderboard, qualifier, 9,  12)   # Q1
-            apply_tiebreaker(leaderboard, qualifier, 13, 16)   # Q2
-            apply_tiebreaker(leaderboard, qualifier, 17, 24)   # Q3
-            apply_tiebreaker(leaderboard, qualifier, 25, 32)   # Q4
-            apply_tiebreaker(leaderboard, qualifier, 33, 48)   # Q5
-            apply_tiebreaker(leaderboard, qualifier, 49, 64)   # Q6
+def apply_tiebreaker_generic(leaderboard, qualifier_rank, ranking_format):
+    if ranking_format:
+        for first_position, second_position in ranking_format['tiebreaks']:
+            apply_tiebreaker(leaderboard, qualifier_rank, first_position, second_position)
 
 
 
@@ -103,370 +254,38 @@ def build_leaderboard_object_basic(rhapi, position, slot, result):
 
 
 
-def build_leaderboard_object(rhapi, position, heats, heat_number, heat_position, result):
-    if heat_number <= len(heats):
-        heat = heats[heat_number-1]
-        # for robustness, don't use heat_results but get results from Round 1 instead
-        races = rhapi.db.races_by_heat(heat.id)
-        if races:
-            race_result = rhapi.db.race_results(races[0])
-            if race_result:
-                heat_leaderboard = race_result[race_result['meta']['primary_leaderboard']]
-                # corner case for heats with missing pilots
-                if heat_position <= len(heat_leaderboard):
-                    slot = heat_leaderboard[heat_position-1]
-
-                    return {
-                        'pilot_id': slot['pilot_id'],
-                        'callsign': slot['callsign'],
-                        'team_name': slot['team_name'],
-                        'position': position,
-                        'result': result
-                    }
+def build_leaderboard_object(rhapi, position, heat_leaderboards, heat_number, heat_position, result):
+    heat_leaderboard = heat_leaderboards.get(heat_number)
+    if heat_leaderboard:
+        # corner case for heats with missing pilots
+        if heat_position <= len(heat_leaderboard):
+            slot = heat_leaderboard[heat_position-1]
+
+            return {
+                'pilot_id': slot['pilot_id'],
+                'callsign': slot['callsign'],
+                'team_name': slot['team_name'],
+                'position': position,
+                'result': result
+            }
 
     return None
 
 
 
-def build_leaderboard_generic(rhapi, heats, bracket_type):
-    logger.info(f"Found {len(heats)} heats in the bracket class")
-    if bracket_type == MULTIGP or bracket_type == CSI:
-        if len(heats) == 6:
-            # ddr8de
-            logger.info(f"Format detected: DDR 8 pilots double elimination (MultiGP style)")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 5, 3, "3° in Heat 5"),
-                build_leaderboard_object(rhapi, 6,  heats, 5, 4, "4° in Heat 5"),
-                build_leaderboard_object(rhapi, 7,  heats, 3, 3, "3° in Heat 3"),
-                build_leaderboard_object(rhapi, 8,  heats, 3, 4, "4° in Heat 3")
-            ]
-        elif len(heats) == 14:
-            # multigp16
-            logger.info(f"Format detected: MultiGP 16 pilots double elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 13, 3, "3° in Heat 13"),
-                build_leaderboard_object(rhapi, 6,  heats, 13, 4, "4° in Heat 13"),
-                build_leaderboard_object(rhapi, 7,  heats, 12, 3, "3° in Heat 12"),
-                build_leaderboard_object(rhapi, 8,  heats, 12, 4, "4° in Heat 12"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 9,  3, "3° in Heat 9"),   # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 10, 3, "3° in Heat 10"),  # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 11, heats, 9,  4, "4° in Heat 9"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 12, heats, 10, 4, "4° in Heat 10"),  # to be fixed Q2
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 13, heats, 5,  3, "3° in Heat 5"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 14, heats, 7,  3, "3° in Heat 7"),   # to be fixed Q3
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 15, heats, 5,  4, "4° in Heat 5"),   # to be fixed Q4
-                build_leaderboard_object(rhapi, 16, heats, 7,  4, "4° in Heat 7")    # to be fixed Q4
-            ]
-        else:
-            # unsupported format
-            return None
-    elif bracket_type == FAI:
-        if len(heats) == 6:
-            # ddr8de
-            logger.info(f"Format detected: DDR 8 pilots double elimination (FAI style)")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 5,  heats, 5, 3, "3° in Heat 5"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 6,  heats, 5, 4, "4° in Heat 5"),  # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 7,  heats, 3, 3, "3° in Heat 3"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 8,  heats, 3, 4, "4° in Heat 3")   # to be fixed Q2
-            ]
-        elif len(heats) == 8:
-            # fai16
-            logger.info(f"Format detected: FAI 16 pilots single elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 7, 1, "1° in Small Final"),
-                build_leaderboard_object(rhapi, 6,  heats, 7, 2, "2° in Small Final"),
-                build_leaderboard_object(rhapi, 7,  heats, 7, 3, "3° in Small Final"),
-                build_leaderboard_object(rhapi, 8,  heats, 7, 4, "4° in Small Final"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 4, 3, "3° in Heat 4"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 4, 4, "4° in Heat 4"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 11, heats, 3, 3, "3° in Heat 3"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 12, heats, 3, 4, "4° in Heat 3"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 13, heats, 2, 3, "3° in Heat 2"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 14, heats, 2, 4, "4° in Heat 2"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 15, heats, 1, 3, "3° in Heat 1"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 16, heats, 1, 4, "4° in Heat 1")   # to be fixed Q1
-            ]
-        elif len(heats) == 14:
-            # fai16de
-            logger.info(f"Format detected: FAI 16 pilots double elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 13, 3, "3° in Heat 13"),
-                build_leaderboard_object(rhapi, 6,  heats, 13, 4, "4° in Heat 13"),
-                build_leaderboard_object(rhapi, 7,  heats, 11, 3, "3° in Heat 11"),
-                build_leaderboard_object(rhapi, 8,  heats, 11, 4, "4° in Heat 11"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 10, 3, "3° in Heat 10"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 10, 4, "4° in Heat 10"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 11, heats, 9,  3, "3° in Heat 9"),   # to be fixed Q1
-                build_leaderboard_object(rhapi, 12, heats, 9,  4, "4° in Heat 9"),   # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 13, heats, 6,  3, "3° in Heat 6"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 14, heats, 6,  4, "4° in Heat 6"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 15, heats, 5,  3, "3° in Heat 5"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 16, heats, 5,  4, "4° in Heat 5")    # to be fixed Q2
-            ]
-        elif len(heats) == 16:
-            # fai32
-            logger.info(f"Format detected: FAI 32 pilots single elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 15, 1, "1° in Small Final"),
-                build_leaderboard_object(rhapi, 6,  heats, 15, 2, "2° in Small Final"),
-                build_leaderboard_object(rhapi, 7,  heats, 15, 3, "3° in Small Final"),
-                build_leaderboard_object(rhapi, 8,  heats, 15, 4, "4° in Small Final"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 12, 3, "3° in Heat 12"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 12, 4, "4° in Heat 12"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 11, heats, 11, 3, "3° in Heat 11"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 12, heats, 11, 4, "4° in Heat 11"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 13, heats, 10, 3, "3° in Heat 10"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 14, heats, 10, 4, "4° in Heat 10"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 15, heats, 9,  3, "3° in Heat 9"),   # to be fixed Q1
-                build_leaderboard_object(rhapi, 16, heats, 9,  4, "4° in Heat 9"),   # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 17, heats, 8,  3, "3° in Heat 8"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 18, heats, 8,  4, "4° in Heat 8"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 19, heats, 7,  3, "3° in Heat 7"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 20, heats, 7,  4, "4° in Heat 7"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 21, heats, 6,  3, "3° in Heat 6"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 22, heats, 6,  4, "4° in Heat 6"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 23, heats, 5,  3, "3° in Heat 5"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 24, heats, 5,  4, "4° in Heat 5"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 25, heats, 4,  3, "3° in Heat 4"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 26, heats, 4,  4, "4° in Heat 4"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 27, heats, 3,  3, "3° in Heat 3"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 28, heats, 3,  4, "4° in Heat 3"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 29, heats, 2,  3, "3° in Heat 2"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 30, heats, 2,  4, "4° in Heat 2"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 31, heats, 1,  3, "3° in Heat 1"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 32, heats, 1,  4, "4° in Heat 1")    # to be fixed Q2
-            ]
-        elif len(heats) == 30:
-            # fai32de
-            logger.info(f"Format detected: FAI 32 pilots double elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 29, 3, "3° in Heat 29"),
-                build_leaderboard_object(rhapi, 6,  heats, 29, 4, "4° in Heat 29"),
-                build_leaderboard_object(rhapi, 7,  heats, 27, 3, "3° in Heat 27"),
-                build_leaderboard_object(rhapi, 8,  heats, 27, 4, "4° in Heat 27"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 26, 3, "3° in Heat 26"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 26, 4, "4° in Heat 26"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 11, heats, 25, 3, "3° in Heat 25"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 12, heats, 25, 4, "4° in Heat 25"),  # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 13, heats, 22, 3, "3° in Heat 22"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 14, heats, 22, 4, "4° in Heat 22"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 15, heats, 21, 3, "3° in Heat 21"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 16, heats, 21, 4, "4° in Heat 21"),  # to be fixed Q2
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 17, heats, 20, 3, "3° in Heat 20"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 18, heats, 20, 4, "4° in Heat 20"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 19, heats, 19, 3, "3° in Heat 19"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 20, heats, 19, 4, "4° in Heat 19"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 21, heats, 18, 3, "3° in Heat 18"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 22, heats, 18, 4, "4° in Heat 18"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 23, heats, 17, 3, "3° in Heat 17"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 24, heats, 17, 4, "4° in Heat 17"),  # to be fixed Q3
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 25, heats, 16, 3, "3° in Heat 16"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 26, heats, 16, 4, "4° in Heat 16"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 27, heats, 15, 3, "3° in Heat 15"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 28, heats, 15, 4, "4° in Heat 15"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 29, heats, 14, 3, "3° in Heat 14"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 30, heats, 14, 4, "4° in Heat 14"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 31, heats, 13, 3, "3° in Heat 13"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 32, heats, 13, 4, "4° in Heat 13")   # to be fixed Q4
-            ]
-        elif len(heats) == 32:
-            # fai64
-            logger.info(f"Format detected: FAI 64 pilots single elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 31, 1, "1° in Small Final"),
-                build_leaderboard_object(rhapi, 6,  heats, 31, 2, "2° in Small Final"),
-                build_leaderboard_object(rhapi, 7,  heats, 31, 3, "3° in Small Final"),
-                build_leaderboard_object(rhapi, 8,  heats, 31, 4, "4° in Small Final"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 28, 3, "3° in Heat 28"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 28, 4, "4° in Heat 28"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 11, heats, 27, 3, "3° in Heat 27"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 12, heats, 27, 4, "4° in Heat 27"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 13, heats, 26, 3, "3° in Heat 26"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 14, heats, 26, 4, "4° in Heat 26"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 15, heats, 25, 3, "3° in Heat 25"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 16, heats, 25, 4, "4° in Heat 25"),  # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 17, heats, 24, 3, "3° in Heat 24"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 18, heats, 24, 4, "4° in Heat 24"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 19, heats, 23, 3, "3° in Heat 23"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 20, heats, 23, 4, "4° in Heat 23"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 21, heats, 22, 3, "3° in Heat 22"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 22, heats, 22, 4, "4° in Heat 22"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 23, heats, 21, 3, "3° in Heat 21"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 24, heats, 21, 4, "4° in Heat 21"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 25, heats, 20, 3, "3° in Heat 20"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 26, heats, 20, 4, "4° in Heat 20"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 27, heats, 19, 3, "3° in Heat 19"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 28, heats, 19, 4, "4° in Heat 19"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 29, heats, 18, 3, "3° in Heat 18"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 30, heats, 18, 4, "4° in Heat 18"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 31, heats, 17, 3, "3° in Heat 17"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 32, heats, 17, 4, "4° in Heat 17"),  # to be fixed Q2
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 33, heats, 16, 3, "3° in Heat 16"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 34, heats, 16, 4, "4° in Heat 16"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 35, heats, 15, 3, "3° in Heat 15"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 36, heats, 15, 4, "4° in Heat 15"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 37, heats, 14, 3, "3° in Heat 14"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 38, heats, 14, 4, "4° in Heat 14"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 39, heats, 13, 3, "3° in Heat 13"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 40, heats, 13, 4, "4° in Heat 13"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 41, heats, 12, 3, "3° in Heat 12"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 42, heats, 12, 4, "4° in Heat 12"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 43, heats, 11, 3, "3° in Heat 11"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 44, heats, 11, 4, "4° in Heat 11"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 45, heats, 10, 3, "3° in Heat 10"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 46, heats, 10, 4, "4° in Heat 10"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 47, heats, 9,  3, "3° in Heat 9"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 48, heats, 9,  4, "4° in Heat 9"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 49, heats, 8,  3, "3° in Heat 8"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 50, heats, 8,  4, "4° in Heat 8"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 51, heats, 7,  3, "3° in Heat 7"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 52, heats, 7,  4, "4° in Heat 7"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 53, heats, 6,  3, "3° in Heat 6"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 54, heats, 6,  4, "4° in Heat 6"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 55, heats, 5,  3, "3° in Heat 5"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 56, heats, 5,  4, "4° in Heat 5"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 57, heats, 4,  3, "3° in Heat 4"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 58, heats, 4,  4, "4° in Heat 4"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 59, heats, 3,  3, "3° in Heat 3"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 60, heats, 3,  4, "4° in Heat 3"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 61, heats, 2,  3, "3° in Heat 2"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 62, heats, 2,  4, "4° in Heat 2"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 63, heats, 1,  3, "3° in Heat 1"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 64, heats, 1,  4, "4° in Heat 1")    # to be fixed Q3
-            ]
-        elif len(heats) == 62:
-            # fai64de
-            logger.info(f"Format detected: FAI 64 pilots double elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 61, 3, "3° in Heat 61"),
-                build_leaderboard_object(rhapi, 6,  heats, 61, 4, "4° in Heat 61"),
-                build_leaderboard_object(rhapi, 7,  heats, 59, 3, "3° in Heat 59"),
-                build_leaderboard_object(rhapi, 8,  heats, 59, 4, "4° in Heat 59"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 58, 3, "3° in Heat 58"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 58, 4, "4° in Heat 58"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 11, heats, 57, 3, "3° in Heat 57"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 12, heats, 57, 4, "4° in Heat 57"),  # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 13, heats, 54, 3, "3° in Heat 54"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 14, heats, 54, 4, "4° in Heat 54"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 15, heats, 53, 3, "3° in Heat 53"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 16, heats, 53, 4, "4° in Heat 53"),  # to be fixed Q2
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 17, heats, 52, 3, "3° in Heat 52"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 18, heats, 52, 4, "4° in Heat 52"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 19, heats, 51, 3, "3° in Heat 51"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 20, heats, 51, 4, "4° in Heat 51"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 21, heats, 50, 3, "3° in Heat 50"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 22, heats, 50, 4, "4° in Heat 50"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 23, heats, 49, 3, "3° in Heat 49"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 24, heats, 49, 4, "4° in Heat 49"),  # to be fixed Q3
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 25, heats, 44, 3, "3° in Heat 44"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 26, heats, 44, 4, "4° in Heat 44"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 27, heats, 43, 3, "3° in Heat 43"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 28, heats, 43, 4, "4° in Heat 43"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 29, heats, 42, 3, "3° in Heat 42"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 30, heats, 42, 4, "4° in Heat 42"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 31, heats, 41, 3, "3° in Heat 41"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 32, heats, 41, 4, "4° in Heat 41"),  # to be fixed Q4
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 33, heats, 40, 3, "3° in Heat 40"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 34, heats, 40, 4, "4° in Heat 40"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 35, heats, 39, 3, "3° in Heat 39"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 36, heats, 39, 4, "4° in Heat 39"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 37, heats, 38, 3, "3° in Heat 38"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 38, heats, 38, 4, "4° in Heat 38"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 39, heats, 37, 3, "3° in Heat 37"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 40, heats, 37, 4, "4° in Heat 37"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 41, heats, 36, 3, "3° in Heat 36"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 42, heats, 36, 4, "4° in Heat 36"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 43, heats, 35, 3, "3° in Heat 35"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 44, heats, 35, 4, "4° in Heat 35"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 45, heats, 34, 3, "3° in Heat 34"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 46, heats, 34, 4, "4° in Heat 34"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 47, heats, 33, 3, "3° in Heat 33"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 48, heats, 33, 4, "4° in Heat 33"),  # to be fixed Q5
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 49, heats, 32, 3, "3° in Heat 32"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 50, heats, 32, 4, "4° in Heat 32"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 51, heats, 31, 3, "3° in Heat 31"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 52, heats, 31, 4, "4° in Heat 31"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 53, heats, 30, 3, "3° in Heat 30"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 54, heats, 30, 4, "4° in Heat 30"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 55, heats, 29, 3, "3° in Heat 29"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 56, heats, 29, 4, "4° in Heat 29"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 57, heats, 28, 3, "3° in Heat 28"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 58, heats, 28, 4, "4° in Heat 28"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 59, heats, 27, 3, "3° in Heat 27"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 60, heats, 27, 4, "4° in Heat 27"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 61, heats, 26, 3, "3° in Heat 26"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 62, heats, 26, 4, "4° in Heat 26"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 63, heats, 25, 3, "3° in Heat 25"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 64, heats, 25, 4, "4° in Heat 25")   # to be fixed Q6
-            ]
-        else:
-            # unsupported format
-            return None
-    else:
+def build_leaderboard_generic(rhapi, heat_leaderboards, ranking_format):
+    logger.info(f"Found {len(heat_leaderboards)} heats in the bracket class")
+    if not ranking_format:
         # unsupported format
         return None
 
+    logger.info(f"Format detected: {ranking_format['description']}")
+    # top 4 positions are handled later due to CTA logic
+    return [None, None, None, None] + [
+        build_leaderboard_object(rhapi, position, heat_leaderboards, heat_number, heat_position, result)
+        for position, heat_number, heat_position, result in ranking_format['rows']
+    ]
+
 
 
 ####################################################################################################
@@ -481,34 +300,30 @@ def brackets(rhapi, race_class, args):
         logger.error(f"Failed building ranking: brackets cannot use themselves as qualifier class")
         return {}, {}
 
-    qualifier_result = None
-    for raceclass in rhapi.db.raceclasses:
-        if int(raceclass.id) == int(args["qualifier_class"]):
-            qualifier_result = rhapi.db.raceclass_results(raceclass)
+    """ reuse the previous ranking if its inputs did not change """
+    # heats are numbered as in the bracket metadata stored at generation, if available
+    metadata = get_bracket_metadata(rhapi, race_class)
+    heats = order_bracket_heats(rhapi.db.heats_by_class(race_class.id), metadata)
+    NUMBER_OF_HEATS = len(heats)
+    ranking_format = get_ranking_format(args["bracket_type"], NUMBER_OF_HEATS, metadata)
 
-    if not qualifier_result:
+    # results of all heats are loaded once, the leaderboard is built by reading them from memory
+    heat_leaderboards = prefetch_heat_leaderboards(rhapi, heats)
+
+    fingerprint = get_ranking_fingerprint(heat_leaderboards, args)
+    cached = ranking_cache.get(race_class.id)
+    if cached and cached[0] == fingerprint:
+        logger.debug(f"Ranking of class {race_class.id} is unchanged, using cached leaderboard")
+        return [dict(x) for x in cached[1]], cached[2]
+
+    qualifier, qualifier_rank = get_qualifier(rhapi, int(args["qualifier_class"]))
+    if qualifier is None:
         logger.error(f"Failed building ranking: qualifier result not available")
         return {}, {}
 
-    qualifier = qualifier_result[qualifier_result['meta']['primary_leaderboard']]
-    # in general, leaderboards are already sorted by position, but sort them explicitly to be sure
-    # however consider that pilots could be without a value for the "position" field (for example if they do not complete any laps),
-    # handle this case by putting them at the end of the leaderboard
-    qualifier_with_position = [x for x in qualifier if x.get("position") is not None]
-    qualifier_without_position = [x for x in qualifier if x.get("position") is None]
-    for i, element in enumerate(qualifier_without_position):
-        if not element.get("position"):
-            element["position"] = len(qualifier_with_position)+i+1
-    # sort by position (to be safe) and extract only the pilot IDs
-    qualifier = list(map(lambda x: x['pilot_id'], sorted(qualifier_with_position, key=lambda x: x['position']) + qualifier_without_position))
-    logger.info(f"Found {len(qualifier)} pilots in the qualifier class")
-
     """ build leaderboard """
-    heats = rhapi.db.heats_by_class(race_class.id)
-    NUMBER_OF_HEATS = len(heats)
-
     try:
-        leaderboard = build_leaderboard_generic(rhapi, heats, args["bracket_type"])
+        leaderboard = build_leaderboard_generic(rhapi, heat_leaderboards, ranking_format)
     except Exception as e:
         logger.error(f"Failed building ranking: an exception occurred while generating leaderboard ({e})")
         return {}, {}
@@ -519,7 +334,7 @@ def brackets(rhapi, race_class, args):
 
     """ apply qualifier results to resolve ties """
     try:
-        apply_tiebreaker_generic(leaderboard, qualifier, NUMBER_OF_HEATS, args["bracket_type"])
+        apply_tiebreaker_generic(leaderboard, qualifier_rank, ranking_format)
     except Exception as e:
         logger.error(f"Failed building ranking: an exception occurred while resolving ties ({e})")
         return {}, {}
@@ -532,23 +347,19 @@ def brackets(rhapi, race_class, args):
             tq_pilot_id = qualifier[0]
 
             # verify that the pilot holding the TQ has won all heats before the final
-            for heat in heats[:-1]:
-                # for robustness, don't use heat_results but get results from Round 1 instead
-                races = rhapi.db.races_by_heat(heat.id)
-                if races:
-                    race_result = rhapi.db.race_results(races[0])
-                    if race_result:
-                        heat_leaderboard = race_result[race_result['meta']['primary_leaderboard']]
-                        pilot_ids = list(map(lambda x: x['pilot_id'], heat_leaderboard))
-                        winner_pilot_id = heat_leaderboard[0]['pilot_id']
-                        if tq_pilot_id in pilot_ids and winner_pilot_id != tq_pilot_id:
-                            IS_IRON_MAN_AVAILABLE = False
-                            break
+            for heat_number in range(1, NUMBER_OF_HEATS):
+                heat_leaderboard = heat_leaderboards.get(heat_number)
+                if heat_leaderboard:
+                    pilot_ids = list(map(lambda x: x['pilot_id'], heat_leaderboard))
+                    winner_pilot_id = heat_leaderboard[0]['pilot_id']
+                    if tq_pilot_id in pilot_ids and winner_pilot_id != tq_pilot_id:
+                        IS_IRON_MAN_AVAILABLE = False
+                        break
         else:
             IS_IRON_MAN_AVAILABLE = False
 
         # initialize data for each pilot in the final
-        slots = rhapi.db.slots_by_heat(heats[-1].id)
+        slots = rhapi.db.slots_by_heat(heats[-1].id) if heats[-1] else []
         winners = {}
         for slot in slots:
             pilot_id = slot.pilot_id
@@ -562,20 +373,21 @@ def brackets(rhapi, race_class, args):
         RACE_IS_OVER = False
 
         # extract rounds from the final
-        races = rhapi.db.races_by_heat(heats[-1].id)
+        races = heat_leaderboards.races[NUMBER_OF_HEATS]
         for race_number, race in enumerate(races):
-            race_result = rhapi.db.race_results(race)
+            heat_leaderboard = get_race_leaderboard(rhapi, race, heat_leaderboards)
 
-            if race_result:
-                heat_leaderboard = race_result[race_result['meta']['primary_leaderboard']]
+            if heat_leaderboard:
+                # the leaderboard is shared with the cache and it is reordered below, so work on a copy
+                heat_leaderboard = list(heat_leaderboard)
                 winner_pilot_id = heat_leaderboard[0]['pilot_id']
 
                 if race_number == 0 and IS_IRON_MAN_AVAILABLE and winner_pilot_id == tq_pilot_id:
                     # race is over (Iron Man)
-                    leaderboard[0] = build_leaderboard_object(rhapi, 1, heats, NUMBER_OF_HEATS, 1, "CTA [1] [1]")
-                    leaderboard[1] = build_leaderboard_object(rhapi, 2, heats, NUMBER_OF_HEATS, 2, "[2] [2]")
-                    leaderboard[2] = build_leaderboard_object(rhapi, 3, heats, NUMBER_OF_HEATS, 3, "[3] [3]")
-                    leaderboard[3] = build_leaderboard_object(rhapi, 4, heats, NUMBER_OF_HEATS, 4, "[4] [4]")
+                    leaderboard[0] = build_leaderboard_object(rhapi, 1, heat_leaderboards, NUMBER_OF_HEATS, 1, "CTA [1] [1]")
+                    leaderboard[1] = build_leaderboard_object(rhapi, 2, heat_leaderboards, NUMBER_OF_HEATS, 2, "[2] [2]")
+                    leaderboard[2] = build_leaderboard_object(rhapi, 3, heat_leaderboards, NUMBER_OF_HEATS, 3, "[3] [3]")
+                    leaderboard[3] = build_leaderboard_object(rhapi, 4, heat_leaderboards, NUMBER_OF_HEATS, 4, "[4] [4]")
 
                     RACE_IS_OVER = True
 
@@ -644,11 +456,11 @@ def brackets(rhapi, race_class, args):
                         # look for ties and solve them
                         if winners[heat_leaderboard[1]['pilot_id']]["big_points"] == winners[heat_leaderboard[2]['pilot_id']]["big_points"] and \
                            winners[heat_leaderboard[1]['pilot_id']]["big_points"] == winners[heat_leaderboard[3]['pilot_id']]["big_points"]:
-                            apply_tiebreaker(leaderboard, qualifier, 2, 4)
+                            apply_tiebreaker(leaderboard, qualifier_rank, 2, 4)
                         elif winners[heat_leaderboard[1]['pilot_id']]["big_points"] == winners[heat_leaderboard[2]['pilot_id']]["big_points"]:
-                            apply_tiebreaker(leaderboard, qualifier, 2, 3)
+                            apply_tiebreaker(leaderboard, qualifier_rank, 2, 3)
                         elif winners[heat_leaderboard[2]['pilot_id']]["big_points"] == winners[heat_leaderboard[3]['pilot_id']]["big_points"]:
-                            apply_tiebreaker(leaderboard, qualifier, 3, 4)
+                            apply_tiebreaker(leaderboard, qualifier_rank, 3, 4)
                         # update top-4 leaderboard
                         leaderboard[0]["result"] = "CTA [1] [1]"
                         leaderboard[1]["result"] = "[2] [2]"
@@ -671,10 +483,10 @@ def brackets(rhapi, race_class, args):
                 previous_winners_names[race_class.id] = curr
     else:
         # if CTA is disabled, just use the results of the last heat
-        leaderboard[0] = build_leaderboard_object(rhapi, 1, heats, NUMBER_OF_HEATS, 1, "1° in Final")
-        leaderboard[1] = build_leaderboard_object(rhapi, 2, heats, NUMBER_OF_HEATS, 2, "2° in Final")
-        leaderboard[2] = build_leaderboard_object(rhapi, 3, heats, NUMBER_OF_HEATS, 3, "3° in Final")
-        leaderboard[3] = build_leaderboard_object(rhapi, 4, heats, NUMBER_OF_HEATS, 4, "4° in Final")
+        leaderboard[0] = build_leaderboard_object(rhapi, 1, heat_leaderboards, NUMBER_OF_HEATS, 1, "1° in Final")
+        leaderboard[1] = build_leaderboard_object(rhapi, 2, heat_leaderboards, NUMBER_OF_HEATS, 2, "2° in Final")
+        leaderboard[2] = build_leaderboard_object(rhapi, 3, heat_leaderboards, NUMBER_OF_HEATS, 3, "3° in Final")
+        leaderboard[3] = build_leaderboard_object(rhapi, 4, heat_leaderboards, NUMBER_OF_HEATS, 4, "4° in Final")
 
     """ remove empty slots """
     leaderboard = list(filter(lambda x: x != None, leaderboard))
@@ -686,6 +498,9 @@ def brackets(rhapi, race_class, args):
         }]
     }
 
+    ranking_cache.set(race_class.id, (fingerprint, [dict(x) for x in leaderboard], meta))
+    logger.info(f"Ranking built with {heat_leaderboards.db_calls} result queries, {heat_leaderboards.db_calls_saved} saved by prefetch")
+
     return leaderboard, meta
 
 ####################################################################################################
@@ -696,14 +511,7 @@ class_rank_method = None
 def register_handlers(rhapi, args):
     global class_rank_method
 
-    classes = rhapi.db.raceclasses
-    options = []
-    for this_class in classes:
-        if not this_class.name:
-            name = f"Class {this_class.id}"
-        else:
-            name = this_class.name
-        options.append(UIFieldSelectOption(this_class.id, name))
+    options = get_class_options(rhapi)
     if len(options) > 0:
         default_class = options[0].value
     else:
@@ -754,8 +562,9 @@ def register_handlers(rhapi, args):
 def initialize(rhapi):
     # initialization
     rhapi.events.on(Evt.CLASS_RANK_INITIALIZE, lambda args: register_handlers(rhapi, args))
-    # update
-    rhapi.events.on(Evt.CLASS_ADD, lambda args: register_handlers(rhapi, args))
-    rhapi.events.on(Evt.CLASS_DUPLICATE, lambda args: register_handlers(rhapi, args))
-    rhapi.events.on(Evt.CLASS_ALTER, lambda args: register_handlers(rhapi, args))
-    rhapi.events.on(Evt.CLASS_DELETE, lambda args: register_handlers(rhapi, args))
+    # update (coalesced, class changes come in bursts)
+    update = debounced(bus, "class_rank_brackets_ui", lambda args: register_handlers(rhapi, args))
+    rhapi.events.on(Evt.CLASS_ADD, update)
+    rhapi.events.on(Evt.CLASS_DUPLICATE, update)
+    rhapi.events.on(Evt.CLASS_ALTER, update)
+    rhapi.events.on(Evt.CLASS_DELETE, update)
@@ -0,0 +1,118 @@
+''' Shared HTTP session for the CSI API '''
+
+import gzip
+import json
+import time
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+
+class LatencyHistogram():
+    ''' Request latencies in milliseconds, counted in fixed buckets '''
+
+    BUCKETS = [50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0
+
+    def add(self, milliseconds):
+        self.count += 1
+        self.total += milliseconds
+        for i, limit in enumerate(self.BUCKETS):
+            if milliseconds <= limit:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def stats(self):
+        buckets = {f"<={limit}ms": count for limit, count in zip(self.BUCKETS, self.counts)}
+        buckets[f">{self.BUCKETS[-1]}ms"] = self.counts[-1]
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count, 1) if self.count else None,
+            'buckets': buckets
+        }
+
+
+
+class ApiClient():
+    ''' One pooled keep-alive session for every call to the CSI API
+
+    - endpoint_fn() returns the base URL, so it can change at runtime
+    - timeout is (connect, read) in seconds and applies to every request
+    - when gzip_fn() returns True, JSON bodies larger than gzip_min_size bytes are sent gzip compressed:
+      off by default, the server must accept requests with Content-Encoding: gzip
+    '''
+
+    def __init__(self, endpoint_fn, timeout=(5, 20), pool_size=4, gzip_fn=None, gzip_min_size=1024):
+        self._endpoint_fn = endpoint_fn
+        self.timeout = timeout
+        self._gzip_fn = gzip_fn
+        self.gzip_min_size = gzip_min_size
+
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session = requests.Session()
+        self._session.mount('https://', self._adapter)
+        self._session.mount('http://', self._adapter)
+        self._session.headers.update({'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'})
+
+        # latency of requests opening a new connection (TCP/TLS handshake included) and reusing one
+        self.latency = {
+            'new_connection': LatencyHistogram(),
+            'keep_alive': LatencyHistogram(),
+            'first_byte': LatencyHistogram()
+        }
+        self.errors = 0
+
+    def url(self, path=''):
+        return self._endpoint_fn() + path
+
+    def _connections(self, url):
+        try:
+            return self._adapter.poolmanager.connection_from_url(url).num_connections
+        except Exception:
+            return 0
+
+    def request(self, method, path='', json_payload=None, data=None, headers=None, timeout=None):
+        url = self.url(path)
+        headers = dict(headers or {})
+
+        if json_payload is not None:
+            data = json.dumps(json_payload).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+            if self._gzip_fn and len(data) >= self.gzip_min_size and self._gzip_fn():
+                data = gzip.compress(data)
+                headers['Content-Encoding'] = 'gzip'
+
+        connections = self._connections(url)
+        start = time.perf_counter()
+        try:
+            response = self._session.request(method, url, data=data, headers=headers, timeout=timeout or self.timeout)
+        except requests.RequestException:
+            self.errors += 1
+            raise
+        elapsed = (time.perf_counter() - start) * 1000
+
+        if self._connections(url) > connections:
+            self.latency['new_connection'].add(elapsed)
+        else:
+            self.latency['keep_alive'].add(elapsed)
+        self.latency['first_byte'].add(response.elapsed.total_seconds() * 1000)
+        return response
+
+    def get(self, path='', **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path='', **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def stats(self):
+        stats = {name: histogram.stats() for name, histogram in self.latency.items()}
+        stats['errors'] = self.errors
+        return stats
@@ -0,0 +1,82 @@
+''' Background connectivity probe for the CSI API '''
+
+import time
+import logging
+import gevent
+from gevent.event import Event
+
+logger = logging.getLogger(__name__)
+
+
+
+class ConnectivityMonitor():
+    ''' Probes the connection every `interval` seconds and keeps the last state
+
+    Handlers read `connected` without touching the network. A failed upload marks the
+    state as stale: the connection is then considered down until a new probe succeeds,
+    which runs right away instead of waiting for the next interval.
+    '''
+
+    def __init__(self, probe_fn, interval_fn):
+        self._probe = probe_fn
+        self._interval_fn = interval_fn
+        self._wakeup = Event()
+        self._greenlet = None
+        self._connected = None  # unknown until the first probe
+        self.stale = False
+        self.probes = 0
+        self.failures = 0
+        self.last_probe = None
+
+    def start(self):
+        if not self._greenlet:
+            self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._greenlet:
+            self._greenlet.kill()
+            self._greenlet = None
+        # unknown again until the next probe
+        self._connected = None
+        self.stale = False
+
+    @property
+    def connected(self):
+        return bool(self._connected) and not self.stale
+
+    def mark_stale(self):
+        if not self.stale:
+            logger.info("Connection to the CSI API marked as stale, probing again")
+        self.stale = True
+        self._wakeup.set()
+
+    def probe(self):
+        try:
+            connected = bool(self._probe())
+        except Exception as e:
+            logger.warning(f"Connectivity probe failed ({e})")
+            connected = False
+        if connected != self._connected:
+            logger.info(f"CSI API is {'reachable' if connected else 'not reachable'}")
+        self._connected = connected
+        self.stale = False
+        self.probes += 1
+        if not connected:
+            self.failures += 1
+        self.last_probe = time.time()
+        return connected
+
+    def _run(self):
+        while True:
+            self.probe()
+            self._wakeup.wait(self._interval_fn())
+            self._wakeup.clear()
+
+    def stats(self):
+        return {
+            'connected': self.connected,
+            'stale': self.stale,
+            'probes': self.probes,
+            'failures': self.failures,
+            'seconds_since_probe': round(time.time() - self.last_probe, 1) if self.last_probe else None
+        }
@@ -1,5 +1,9 @@
 from eventmanager import Evt
+from flask import Response, request, stream_with_context
+from flask.blueprints import Blueprint
 from .csi_export_impl import CSIExport
+from ..cache_bus import bus
+from ..debounce import debounced
 
 
 def initialize(rhapi):
@@ -7,11 +11,14 @@ def initialize(rhapi):
     csi_export = CSIExport(rhapi)
     
     rhapi.events.on(Evt.STARTUP, csi_export.init_plugin)  
+    rhapi.events.on(Evt.OPTION_SET, csi_export.option_listener)
 
-    rhapi.events.on(Evt.CLASS_ADD, csi_export.init_ui, priority = 20)
-    rhapi.events.on(Evt.CLASS_DUPLICATE, csi_export.init_ui, priority = 20)
-    rhapi.events.on(Evt.CLASS_ALTER, csi_export.init_ui, priority = 50)
-    rhapi.events.on(Evt.CLASS_DELETE, csi_export.init_ui)
+    # class changes come in bursts (e.g. when an event is created): rebuild the UI once
+    init_ui = debounced(bus, "csi_export_ui", csi_export.init_ui)
+    rhapi.events.on(Evt.CLASS_ADD, init_ui, priority = 20)
+    rhapi.events.on(Evt.CLASS_DUPLICATE, init_ui, priority = 20)
+    rhapi.events.on(Evt.CLASS_ALTER, init_ui, priority = 50)
+    rhapi.events.on(Evt.CLASS_DELETE, init_ui)
 
     #rhapi.events.on(Evt.HEAT_GENERATE, fpvscores.heat_listener, priority = 99)
     #rhapi.events.on(Evt.HEAT_ALTER, fpvscores.heat_listener)
@@ -24,4 +31,24 @@ def initialize(rhapi):
     #rhapi.events.on(Evt.LAPS_SAVE, fpvscores.results_listener)
     #rhapi.events.on(Evt.LAPS_RESAVE, fpvscores.results_listener)
 
-    rhapi.events.on(Evt.DATA_EXPORT_INITIALIZE, csi_export.register_handlers)
\ No newline at end of file
+    rhapi.events.on(Evt.DATA_EXPORT_INITIALIZE, csi_export.register_handlers)
+
+    bp = Blueprint('csi_export', __name__)
+
+    # same content of the "CSV CSI Upload" exporter, sent to the browser while it is written
+    # classes can be given as query parameters, otherwise the ones in the settings panel are used
+    @bp.route('/csi_export/final_leaderboard.csv')
+    def csi_export_streamFinalLeaderboard():
+        qualifier_class_id = request.args.get('qualifier_class', type=int)
+        final_class_id = request.args.get('final_class', type=int)
+        if qualifier_class_id and final_class_id:
+            rows = csi_export.export_event(qualifier_class_id, final_class_id, request.args.get('small_final_class', type=int))
+        else:
+            rows = csi_export.exportFinalLeaderboard(None)
+        return Response(stream_with_context(csi_export.iter_csv(rows)),
+                        mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=final_leaderboard.csv'})
+
+    rhapi.ui.blueprint_add(bp)
+
+    return csi_export
\ No newline at end of file
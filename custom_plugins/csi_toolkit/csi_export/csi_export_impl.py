@@ -8,18 +8,107 @@ from data_export import DataExporter
 #from sqlalchemy import inspect
 import re
 from RHUI import UIField, UIFieldType, UIFieldSelectOption
+from eventmanager import Evt
+from ..cache_bus import bus, get_class_options, class_of_race, class_of_event
+from .sync_worker import SyncWorker
+from .api_client import ApiClient
+from .connectivity import ConnectivityMonitor
+
+# final leaderboards of the exported events, the key contains the last saved race of each class
+# and a generation bumped whenever a race of the class is saved again or the class is changed
+EXPORT_CACHE_SIZE = 32
+export_cache = bus.cache('exports', max_size=EXPORT_CACHE_SIZE)
+bus.on(Evt.LAPS_SAVE, 'exports', class_of_race)
+bus.on(Evt.LAPS_RESAVE, 'exports', class_of_race)
+bus.on(Evt.CLASS_ALTER, 'exports', class_of_event)
+bus.on(Evt.CLASS_DELETE, 'exports', class_of_event)
+bus.on(Evt.PILOT_ALTER, 'exports')
+bus.on(Evt.ROUNDS_RESET, 'exports')
+bus.on(Evt.DATABASE_RESET, 'exports')
+
+# laps the CSI API confirmed, race id -> {lap id: (lap_time_stamp, lap_time, deleted)}
+uploaded_laps_cache = bus.cache('uploaded_laps')
+bus.on(Evt.ROUNDS_RESET, 'uploaded_laps')
+bus.on(Evt.DATABASE_RESET, 'uploaded_laps')
+# laps of the last upload queued for each race, same layout
+queued_laps_cache = bus.cache('queued_laps')
+bus.on(Evt.ROUNDS_RESET, 'queued_laps')
+bus.on(Evt.DATABASE_RESET, 'queued_laps')
+
+
+
+class PilotResult():
+    ''' Export columns of a pilot in a class, readable and writable like a dict '''
+
+    __slots__ = ("classid", "classname", "pilot_id", "callsign", "position", "method_label",
+                 "consecutives", "fastest_lap", "fastest_lap_raw", "qualifier_position", "tq", "the_fastest")
+
+    def __init__(self, classid, classname, pilot_id, callsign, position):
+        self.classid = classid
+        self.classname = classname
+        self.pilot_id = pilot_id
+        self.callsign = callsign
+        self.position = position
+
+    def __getitem__(self, key):
+        if key not in self.__slots__ or not hasattr(self, key):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def __eq__(self, other):
+        return dict(self) == dict(other)
+
+
 
 class CSIExport():
     CSI_VERSION = "x.y.z"
     CSI_API_ENDPOINT = "https://api.abcdef.com"
     CSI_API_VERSION = "x.y.z"
     CSI_UPDATE_REQ = False
+    CSI_API_TIMEOUT = (5, 20)  # connect, read (seconds)
+    CSI_PROBE_INTERVAL = 30    # seconds between connectivity probes (option csi_probe_interval)
+    SYNC_OPTIONS = ["csi_autoupload", "csi_event_uuid"]  # the probe and the upload worker run only while both are set
+    RESULT_LEADERBOARDS = ["by_consecutives", "by_race_time", "by_fastest_lap"]
+    LAP_COLUMNS = ["id", "pilotrace_id", "pilot_id", "lap_time_stamp", "lap_time", "lap_time_formatted", "deleted", "node_index"]
+
+    CSV_HEADER = ["Pos Qual", "Pos", "Cognome Nome", "Pole", "Best lap Qual", "Best lap Gara", "Best Lap"]
+    CSV_FIELDS = ["qualifier_position", "position", "callsign", "tq", "consecutives", "fastest_lap", "the_fastest"]
+    CSV_CHUNK_ROWS = 100
     
     def __init__(self, rhapi):
         self.logger = logging.getLogger(__name__)
         self._rhapi = rhapi
+        # every call to the CSI API goes through one pooled keep-alive session
+        self.api = ApiClient(self.getApiEndpoint, timeout=self.CSI_API_TIMEOUT, gzip_fn=self.isGzipEnabled)
+        bus.add_stats_provider('api', self.api.stats)
+        # connection state is probed in background, handlers only read the last result
+        self.connectivity = ConnectivityMonitor(self.probeConnection, self.getProbeInterval)
+        bus.add_stats_provider('connectivity', self.connectivity.stats)
+        # uploads run in background, the worker waits while the connection is down
+        self.sync = SyncWorker(self.post_action,
+                               on_response=lambda text: self.UI_Message(self._rhapi, text),
+                               can_send=self.isConnected,
+                               on_failure=self.onUploadFailure,
+                               on_sent=self.onUploadSent)
+        bus.add_stats_provider('sync', self.sync.stats)
 
     def init_plugin(self, args):
+        self.updateSyncState()
+
         #isEnabled = self.isEnabled()
         #isConnected = self.isConnected()
         #notEmptyKeys = self.getEventUUID()["notempty"]
@@ -49,14 +138,7 @@ class CSIExport():
         ui = self._rhapi.ui
         ui.register_panel("csi_export_panel", "CSI Export Settings", "format")
 
-        classes = self._rhapi.db.raceclasses
-        options = []
-        for this_class in classes:
-            if not this_class.name:
-                name = f"Class {this_class.id}"
-            else:
-                name = this_class.name
-            options.append(UIFieldSelectOption(this_class.id, name))
+        options = get_class_options(self._rhapi)
         if len(options) > 0:
             default_class = options[0].value
         else:
@@ -88,6 +170,9 @@ class CSIExport():
                                      desc = "Class used in small final stage (if enabled)")
         fields.register_option(ui_csi_enable_small_final, "csi_export_panel")
         fields.register_option(ui_csi_small_final, "csi_export_panel")
+
+        ui_csi_gzip = UIField(name = "csi_gzip_uploads", label = "Compress Uploads", field_type = UIFieldType.CHECKBOX, value = False, desc = "Send large uploads gzip compressed. Enable only if the CSI API accepts compressed requests")
+        fields.register_option(ui_csi_gzip, "csi_export_panel")
         
         #ui_csi_autosync = UIField(name = "csi_autoupload", label = "Enable Automatic Sync", field_type = UIFieldType.CHECKBOX, desc = "Enable or disable automatic syncing. A network connection is required.")
         #ui_csi_event_uuid = UIField(name = "csi_event_uuid", label = "FPV Scores Event UUID", field_type = UIFieldType.TEXT, desc = "Event UUID obtainable from FPVScores.com")
@@ -109,12 +194,73 @@ class CSIExport():
 
         #ui.register_quickbutton("csi_export_panel", "csi_downloadavatars", "Download Pilot Avatars", self.runDownloadAvatarsBtn, {'rhapi': self._rhapi})
 
+    def updateSyncState(self):
+        # without a sync there is nothing to upload and no reason to probe the API
+        if self.isEnabled() and self.getEventUUID()["notempty"]:
+            self.connectivity.start()
+            self.sync.start()
+        else:
+            self.connectivity.stop()
+            self.sync.stop()
+
+    def option_listener(self, args):
+        if args.get("option") in self.SYNC_OPTIONS:
+            self.updateSyncState()
+
     def isConnected(self):
+        # cached state, no network access
+        return self.connectivity.connected
+
+    def onUploadFailure(self, error):
+        # a network error makes the cached state unreliable until the next probe
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            self.connectivity.mark_stale()
+
+    def onUploadSent(self, action, payload):
+        # the laps the server has: a delta not uploaded yet (pending, failed or dropped) is included in the next one
+        if action == "laptimes_update":
+            uploaded_laps_cache.set(payload["raceid"], {lap["id"]: (lap["lap_time_stamp"], lap["lap_time"], lap["deleted"])
+                                                        for lap in payload["pilotlaps"]})
+        elif action == "laptimes_delta":
+            raceid = payload["raceid"]
+            previous = uploaded_laps_cache.get(raceid)
+            if payload["delta"] and previous is None:
+                # confirmed laps lost (e.g. restart with pending uploads): the next upload sends every lap
+                return
+            laps = dict(previous) if payload["delta"] else dict()
+            columns = payload["pilotlaps_columns"]
+            for lap_id, lap_time_stamp, lap_time, deleted in zip(columns["id"], columns["lap_time_stamp"], columns["lap_time"], columns["deleted"]):
+                laps[lap_id] = (lap_time_stamp, lap_time, deleted)
+            for lap_id in payload["removed_lap_ids"]:
+                laps.pop(lap_id, None)
+            uploaded_laps_cache.set(raceid, laps)
+
+    def getProbeInterval(self):
         try:
-            response = requests.get(self.CSI_API_ENDPOINT, timeout=5)
+            return max(5, int(self._rhapi.db.option("csi_probe_interval") or self.CSI_PROBE_INTERVAL))
+        except ValueError:
+            return self.CSI_PROBE_INTERVAL
+
+    def probeConnection(self):
+        try:
+            # any HTTP answer, even an error status, means the server is reachable
+            self.api.get(timeout=5)
             return True
-        except requests.ConnectionError:
-            return False 
+        except requests.RequestException:
+            return False
+
+    def isGzipEnabled(self):
+        # opt-in: not every server accepts compressed request bodies
+        return self._rhapi.db.option("csi_gzip_uploads") == "1"
+
+    def getApiEndpoint(self):
+        # can be pointed to a local server to test the sync offline
+        return self._rhapi.db.option("csi_api_endpoint") or self.CSI_API_ENDPOINT
+
+    def post_action(self, action, payload):
+        x = self.api.post("/rh/"+self.CSI_API_VERSION+"/?action="+action, json_payload = payload)
+        x.raise_for_status()
+        return x.text
 
     def isEnabled(self):
         enabled = self._rhapi.db.option("csi_autoupload")
@@ -139,7 +285,7 @@ class CSIExport():
         rhapi = self._rhapi
         
         keys = self.getEventUUID()
-        if self.isConnected() and self.isEnabled() and keys["notempty"]:
+        if self.isEnabled() and keys["notempty"]:
             eventname = args["_eventName"]
             if eventname == "classAdd":
                 classid = args["class_id"]
@@ -169,8 +315,7 @@ class CSIExport():
                 "class_bracket_type": brackettype,
                 "event_name": eventname
             }
-            x = requests.post(self.CSI_API_ENDPOINT+"/rh/"+self.CSI_API_VERSION+"/?action=class_update", json = payload)
-            self.UI_Message(rhapi,x.text)
+            self.sync.enqueue("class_update", payload, key = classid)
         else:
             self.logger.warning("FPVScores.com Sync Disabled")
 
@@ -263,9 +408,7 @@ class CSIExport():
         payload = {
             "event_uuid": keys["event_uuid"],
         }
-        x = requests.post(self.CSI_API_ENDPOINT+"/rh/"+self.CSI_API_VERSION+"/?action=rh_clear", json = payload)
-        print(x.text)
-        self.UI_Message(rhapi, x.text)
+        self.sync.enqueue("rh_clear", payload)
         
     def runFullManualSyncBtn(self, args):
         rhapi = self._rhapi
@@ -275,112 +418,82 @@ class CSIExport():
     def uploadToFPVS_frombtn(self, input_data):
         rhapi = self._rhapi
         json_data =  input_data['data']
-        url = self.CSI_API_ENDPOINT+"/rh/"+self.CSI_API_VERSION+"/?action=full_manual_import"
+        path = "/rh/"+self.CSI_API_VERSION+"/?action=full_manual_import"
         headers = {'Authorization' : 'rhconnect', 'Accept' : 'application/json', 'Content-Type' : 'application/json'}
-        r = requests.post(url, data=json_data, headers=headers)
+        r = self.api.post(path, data=json_data, headers=headers)
         self.UI_Message(rhapi, r.text)
         print(r.text)
 
     def generate_results_for_class(self, class_id):
+        # single pass: ranking first, then one leaderboard of the class results
+        # (the leaderboards hold the same values for each pilot, only the order changes)
         raceclass = self._rhapi.db.raceclass_by_id(class_id)
         ranking = raceclass.ranking
 
         rankpayload = dict()
         if ranking != None:
-            if isinstance(ranking, bool) and ranking is False:
-                rankpayload = dict()
-            else:
-                meta = ranking["meta"]
-                method_label = meta["method_label"]
-                ranks = ranking["ranking"]
-                for rank in ranks:
-                    rank_values = rank.copy()
-
-                    pilot_id = rank_values.pop("pilot_id", None)
-                    callsign = rank_values.pop("callsign", None)
-                    position = rank_values.pop("position", None)
-                    # team_name = rank_values.pop("team_name", None)
-                    # node = rank_values.pop("node", None)
-                    # total_time_laps = rank_values.pop("total_time_laps", None)
-                    # heat = rank_values.pop("heat", None)
-
-                    pilot = {
-                        "classid": class_id,
-                        "classname": raceclass.name,
-                        "pilot_id": pilot_id,
-                        "callsign": callsign,
-                        "position": position,
-                        # "team_name": team_name,
-                        # "node": node,
-                        # "heat": heat,
-                        "method_label": method_label,
-                        # "rank_fields": meta["rank_fields"],
-                        # "rank_values": rank_values,  # Qui rimangono solo i valori rimanenti
-                    }
-
-                    #print(pilot)
-
-                    rankpayload[pilot_id] = pilot
-
-            db = self._rhapi.db    
-            fullresults = db.raceclass_results(class_id)
+            if ranking:
+                method_label = ranking["meta"]["method_label"]
+                for rank in ranking["ranking"]:
+                    pilot = PilotResult(class_id, raceclass.name, rank.get("pilot_id"), rank.get("callsign"), rank.get("position"))
+                    pilot.method_label = method_label
+                    rankpayload[pilot.pilot_id] = pilot
+
+            fullresults = self._rhapi.db.raceclass_results(class_id)
             if fullresults is not None:
-                meta = fullresults["meta"]
-                leaderboards = ["by_consecutives", "by_race_time", "by_fastest_lap"]
-                for leaderboard in leaderboards:
-                    if leaderboard in fullresults:
-                        for result in fullresults[leaderboard]:
-                            pilot_id = result["pilot_id"]
-                            if pilot_id in rankpayload:
-                                rankpayload[pilot_id]["consecutives"] = result["consecutives"]
-                                rankpayload[pilot_id]["fastest_lap"] = result["fastest_lap"]
-                                rankpayload[pilot_id]["fastest_lap_raw"] = result["fastest_lap_raw"]
-                            else:
-                                rank_values = result.copy()
-
-                                pilot_id = rank_values.pop("pilot_id", None)
-                                callsign = rank_values.pop("callsign", None)
-                                position = rank_values.pop("position", None)
-                                # team_name = rank_values.pop("team_name", None)
-                                # node = rank_values.pop("node", None)
-                                # total_time_laps = rank_values.pop("total_time_laps", None)
-                                # heat = rank_values.pop("heat", None)
-                                consecutives = rank_values.pop("consecutives", None)
-                                fastest_lap = rank_values.pop("fastest_lap", None)
-                                fastest_lap_raw = rank_values.pop("fastest_lap_raw", None)
-
-                                pilot = {
-                                    "classid": class_id,
-                                    "classname": raceclass.name,
-                                    "pilot_id": pilot_id,
-                                    "callsign": callsign,
-                                    "position": position,
-                                    # "team_name": team_name,
-                                    # "node": node,
-                                    # "heat": heat,
-                                    "consecutives": consecutives,
-                                    "fastest_lap": fastest_lap,
-                                    "fastest_lap_raw": fastest_lap_raw,
-                                    # "rank_fields": meta["rank_fields"],
-                                    # "rank_values": rank_values,  # Qui rimangono solo i valori rimanenti
-                                }
-
-                                #print(pilot)
-
-                                rankpayload[pilot_id] = pilot
-                                
+                leaderboard = next((fullresults[name] for name in self.RESULT_LEADERBOARDS if name in fullresults), [])
+                for result in leaderboard:
+                    pilot = rankpayload.get(result["pilot_id"])
+                    if pilot is None:
+                        pilot = PilotResult(class_id, raceclass.name, result["pilot_id"], result.get("callsign"), result.get("position"))
+                        rankpayload[pilot.pilot_id] = pilot
+                    pilot.consecutives = result.get("consecutives")
+                    pilot.fastest_lap = result.get("fastest_lap")
+                    pilot.fastest_lap_raw = result.get("fastest_lap_raw")
+
         return rankpayload
 
     def exportFinalLeaderboard(self, args):
-        rhapi = self._rhapi
-        keys = self.getEventUUID()
-
+        # classes selected in the CSI Export Settings panel
         qualifier_class_id = self._rhapi.db.option('qualifier_class')
         final_class_id = self._rhapi.db.option('final_class')
         small_final_class_id = self._rhapi.db.option('small_final_class')
 
         SMALL_FINALS_ENABLED = (self._rhapi.db.option("csi_small_final") == "1")
 
+        return self.export_event(qualifier_class_id, final_class_id, small_final_class_id if SMALL_FINALS_ENABLED else None)
+
+    def export_event(self, qualifier_class_id, final_class_id, small_final_class_id=None):
+        # final leaderboard of an event, the classes are given explicitly (small final class is None if disabled)
+        # reentrant: it reads no options, cached results are shared read-only and every call gets its own copy
+        key = self.get_export_key([qualifier_class_id, final_class_id, small_final_class_id])
+        rows = export_cache.get(key)
+        if rows is None:
+            rows = self.build_event_leaderboard(qualifier_class_id, final_class_id, small_final_class_id)
+            export_cache.set(key, [dict(row) for row in rows])
+        else:
+            self.logger.debug(f"Export of classes {key} is unchanged, using cached leaderboard")
+        return [dict(row) for row in rows]
+
+    def get_export_key(self, class_ids):
+        key = []
+        for class_id in class_ids:
+            if class_id is None:
+                key.append(None)
+                continue
+            # class ids coming from the options are strings
+            try:
+                class_id = int(class_id)
+            except ValueError:
+                pass
+            races = self._rhapi.db.races_by_raceclass(class_id)
+            last_race_id = max((race.id for race in races), default=0)
+            key.append((class_id, last_race_id, export_cache.generation(class_id)))
+        return tuple(key)
+
+    def build_event_leaderboard(self, qualifier_class_id, final_class_id, small_final_class_id=None):
+        SMALL_FINALS_ENABLED = small_final_class_id is not None
+
         qualifier_leaderboard = self.generate_results_for_class(qualifier_class_id)
         final_class_leaderboard = self.generate_results_for_class(final_class_id)
         if SMALL_FINALS_ENABLED:
@@ -405,6 +518,13 @@ class CSIExport():
             print(json.dumps(small_final_class_leaderboard[elem], indent=2))
         """
 
+        return self.merge_final_leaderboard(qualifier_leaderboard, final_class_leaderboard, small_final_class_leaderboard, SMALL_FINALS_ENABLED)
+
+    def merge_final_leaderboard(self, qualifier_leaderboard, final_class_leaderboard, small_final_class_leaderboard, small_finals_enabled):
+        # leaderboards are dicts indexed by pilot_id (see generate_results_for_class),
+        # so qualifier and small final data of each pilot is a direct lookup
+        rhapi = self._rhapi
+
         # Ordinamento dei piloti nella leaderboard finale:
         # - Dal 1° al 16° posto si prendono i risultati delle finali
         # - Dal 17° posto in poi si prendono i piloti dal 3° posto in poi delle finaline
@@ -439,7 +559,7 @@ class CSIExport():
 
         position = 1
         the_fastest_lap = float('+inf')
-        if SMALL_FINALS_ENABLED:
+        if small_finals_enabled:
             final_leaderboard = final_class_leaderboard_sorted[:16] + small_final_class_leaderboard_sorted[2:]
         else:
             final_leaderboard = final_class_leaderboard_sorted[:16] + qualifier_leaderboard_sorted[16:]
@@ -447,26 +567,26 @@ class CSIExport():
         for element in final_leaderboard:
             element["position"] = position
             element["the_fastest"] = 0
-            for qualifier_element in qualifier_leaderboard_sorted:
-                if qualifier_element["pilot_id"] == element["pilot_id"]:
-                    element["qualifier_position"] = qualifier_element["position"]
-                    element["tq"] = 1 if (qualifier_element["position"] == 1) else 0
-                    element["consecutives"] = qualifier_element["consecutives"] if qualifier_element["consecutives"] else rhapi.utils.format_time_to_str(0)
+            qualifier_element = qualifier_leaderboard.get(element["pilot_id"])
+            if qualifier_element:
+                element["qualifier_position"] = qualifier_element["position"]
+                element["tq"] = 1 if (qualifier_element["position"] == 1) else 0
+                element["consecutives"] = qualifier_element["consecutives"] if qualifier_element["consecutives"] else rhapi.utils.format_time_to_str(0)
+                if element["fastest_lap_raw"] == 0:
+                    element["fastest_lap_raw"] = qualifier_element["fastest_lap_raw"]
+                if element["fastest_lap_raw"] != 0 and qualifier_element["fastest_lap_raw"] != 0:
+                    element["fastest_lap_raw"] = min(element["fastest_lap_raw"], qualifier_element["fastest_lap_raw"])
+                if element["fastest_lap_raw"] != 0:
+                    the_fastest_lap = min(the_fastest_lap, element["fastest_lap_raw"])
+            if small_finals_enabled:
+                small_final_element = small_final_class_leaderboard.get(element["pilot_id"])
+                if small_final_element:
                     if element["fastest_lap_raw"] == 0:
-                        element["fastest_lap_raw"] = qualifier_element["fastest_lap_raw"]
-                    if element["fastest_lap_raw"] != 0 and qualifier_element["fastest_lap_raw"] != 0:
-                        element["fastest_lap_raw"] = min(element["fastest_lap_raw"], qualifier_element["fastest_lap_raw"])
+                        element["fastest_lap_raw"] = small_final_element["fastest_lap_raw"]
+                    if element["fastest_lap_raw"] != 0 and small_final_element["fastest_lap_raw"] != 0:
+                        element["fastest_lap_raw"] = min(element["fastest_lap_raw"], small_final_element["fastest_lap_raw"])
                     if element["fastest_lap_raw"] != 0:
                         the_fastest_lap = min(the_fastest_lap, element["fastest_lap_raw"])
-            if SMALL_FINALS_ENABLED:
-                for small_final_element in small_final_class_leaderboard_sorted:
-                    if small_final_element["pilot_id"] == element["pilot_id"]:
-                        if element["fastest_lap_raw"] == 0:
-                            element["fastest_lap_raw"] = small_final_element["fastest_lap_raw"]
-                        if element["fastest_lap_raw"] != 0 and small_final_element["fastest_lap_raw"] != 0:
-                            element["fastest_lap_raw"] = min(element["fastest_lap_raw"], small_final_element["fastest_lap_raw"])
-                        if element["fastest_lap_raw"] != 0:
-                            the_fastest_lap = min(the_fastest_lap, element["fastest_lap_raw"])
             # get printable time
             element["fastest_lap"] = rhapi.utils.format_time_to_str(element["fastest_lap_raw"])
             position += 1
@@ -486,11 +606,24 @@ class CSIExport():
         
         return final_leaderboard
 
+    def iter_csv(self, rows):
+        # yields the CSV export in chunks of CSV_CHUNK_ROWS rows, so it can be streamed
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=';', quoting=csv.QUOTE_ALL, lineterminator='\n')
+        writer.writerow(self.CSV_HEADER)
+        for i, row in enumerate(rows, start=1):
+            writer.writerow([row[field] for field in self.CSV_FIELDS])
+            if i % self.CSV_CHUNK_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+        yield buffer.getvalue()
+
     def laptime_listener(self, args):
         rhapi = self._rhapi
         keys = self.getEventUUID()
 
-        if self.isConnected() and self.isEnabled() and keys["notempty"]:
+        if self.isEnabled() and keys["notempty"]:
 
             raceid = args["race_id"]
 
@@ -506,27 +639,7 @@ class CSIExport():
             primary_leaderboard = raceresults["meta"]["primary_leaderboard"]
             filteredraceresults = raceresults[primary_leaderboard]
 
-            pilotruns = self._rhapi.db.pilotruns_by_race(raceid)
-
-            pilotlaps = []
-            for run in pilotruns:
-                runid = run.id
-                laps = self._rhapi.db.laps_by_pilotrun(runid)
-                for lap in laps:
-
-                    if lap.deleted == False:
-                        thislap = {
-                            "id": lap.id,
-                            "race_id": lap.race_id,
-                            "pilotrace_id": lap.pilotrace_id,
-                            "pilot_id": lap.pilot_id,
-                            "lap_time_stamp": lap.lap_time_stamp,
-                            "lap_time": lap.lap_time,
-                            "lap_time_formatted": lap.lap_time_formatted,
-                            "deleted": 1 if lap.deleted else 0,
-                            "node_index": lap.node_index
-                        }
-                        pilotlaps.append(thislap)
+            laps = self.get_race_laps(raceid)
 
             payload = {
                 "event_uuid": keys["event_uuid"],
@@ -536,14 +649,72 @@ class CSIExport():
                 "heatid": heatid,
                 "roundid": roundid,
                 "method_label": primary_leaderboard,
-                "roundresults": filteredraceresults,
-                "pilotlaps": pilotlaps
+                "roundresults": filteredraceresults
             }
 
-            x = requests.post(self.CSI_API_ENDPOINT+"/rh/"+self.CSI_API_VERSION+"/?action=laptimes_update", json = payload)
-            #print(x.text)
-            self.UI_Message(rhapi, x.text)
-            self.logger.info("Laps sent to cloud")
+            if self._rhapi.db.option("csi_delta_laps") == "1":
+                # only laps added or changed since the previous upload of the race, as columns
+                payload.update(self.get_laps_delta(raceid, laps))
+                # each delta holds every change since the last confirmed upload, so the latest one wins
+                self.sync.enqueue("laptimes_delta", payload, key = raceid)
+            else:
+                payload["pilotlaps"] = [self.lap_to_dict(lap) for lap in laps if lap.deleted == False]
+                self.sync.enqueue("laptimes_update", payload, key = raceid)
+            self.logger.info("Laps queued for upload")
+
+    def get_race_laps(self, raceid):
+        # RHAPI has no per race lap query: one query for the runs, then one per run (at most one per node)
+        laps = []
+        for run in self._rhapi.db.pilotruns_by_race(raceid):
+            laps.extend(self._rhapi.db.laps_by_pilotrun(run.id))
+        return laps
+
+    def lap_to_dict(self, lap):
+        return {
+            "id": lap.id,
+            "race_id": lap.race_id,
+            "pilotrace_id": lap.pilotrace_id,
+            "pilot_id": lap.pilot_id,
+            "lap_time_stamp": lap.lap_time_stamp,
+            "lap_time": lap.lap_time,
+            "lap_time_formatted": lap.lap_time_formatted,
+            "deleted": 1 if lap.deleted else 0,
+            "node_index": lap.node_index
+        }
+
+    def get_laps_delta(self, raceid, laps):
+        # laps that differ from the ones the server confirmed or from the last ones queued
+        # (a lap changed by an upload still running and changed back is sent again)
+        previous = uploaded_laps_cache.get(raceid)
+        queued = queued_laps_cache.get(raceid) or dict()
+        current = {lap.id: (lap.lap_time_stamp, lap.lap_time, 1 if lap.deleted else 0) for lap in laps}
+
+        if previous is None:
+            # first upload of the race (or after a restart): send every lap that is not deleted
+            changed = [lap for lap in laps if lap.deleted == False]
+            removed = []
+        else:
+            changed = [lap for lap in laps if previous.get(lap.id) != current[lap.id]
+                       or queued.get(lap.id, current[lap.id]) != current[lap.id]]
+            removed = [lap_id for lap_id in dict.fromkeys(list(previous) + list(queued)) if lap_id not in current]
+        queued_laps_cache.set(raceid, current)
+
+        columns = {column: [] for column in self.LAP_COLUMNS}
+        for lap in changed:
+            columns["id"].append(lap.id)
+            columns["pilotrace_id"].append(lap.pilotrace_id)
+            columns["pilot_id"].append(lap.pilot_id)
+            columns["lap_time_stamp"].append(lap.lap_time_stamp)
+            columns["lap_time"].append(lap.lap_time)
+            columns["lap_time_formatted"].append(lap.lap_time_formatted)
+            columns["deleted"].append(1 if lap.deleted else 0)
+            columns["node_index"].append(lap.node_index)
+
+        return {
+            "delta": previous is not None,
+            "pilotlaps_columns": columns,
+            "removed_lap_ids": removed
+        }
 
     # bozza di funzione per ottenere i risultati delle heat per ranking o per fastest lap, top consecutive ecc...
     def results_listener(self, args):
@@ -558,7 +729,7 @@ class CSIExport():
         raceclass = self._rhapi.db.raceclass_by_id(classid)
         classname = raceclass.name
         ranking = raceclass.ranking
-        if self.isConnected() and self.isEnabled() and keys["notempty"]:
+        if self.isEnabled() and keys["notempty"]:
 
             rankpayload = []
             resultpayload = []
@@ -653,15 +824,14 @@ class CSIExport():
                     "results": resultpayload,
                     "classid": classid
                 }
-                x = requests.post(self.CSI_API_ENDPOINT+"/rh/"+self.CSI_API_VERSION+"/?action=leaderboard_update", json = payload)
-                print(x.text)
-                self.UI_Message(rhapi, x.text)
+                # the latest leaderboard of the class replaces any pending one
+                self.sync.enqueue("leaderboard_update", payload, key = classid)
 
-                self.logger.info("Results sent to cloud")
+                self.logger.info("Results queued for upload")
             else:
                 self.logger.info("No results available to resync")
         else:
-            self.logger.warning("No internet connection available")
+            self.logger.warning("FPVScores.com Sync Disabled")
 
     def register_handlers(self, args):
         """
@@ -671,13 +841,10 @@ class CSIExport():
         """
 
         def write_csv(data):
-            output = io.StringIO()
-            output.write('"Pos Qual";"Pos";"Cognome Nome";"Pole";"Best lap Qual";"Best lap Gara";"Best Lap"\n')
-            for row in data:
-                output.write(f'"{row["qualifier_position"]}";"{row["position"]}";"{row["callsign"]}";"{row["tq"]}";"{row["consecutives"]}";"{row["fastest_lap"]}";"{row["the_fastest"]}"\n')
+            output = ''.join(self.iter_csv(data))
 
             return {
-                'data': output.getvalue(),
+                'data': output,
                 'encoding': 'text/csv',
                 'ext': 'csv'
             }
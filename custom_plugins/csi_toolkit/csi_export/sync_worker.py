@@ -0,0 +1,190 @@
+''' Background upload queue for the CSI cloud sync '''
+
+import os
+import json
+import time
+import random
+import logging
+import gevent
+from gevent.event import Event
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# relative to the RotorHazard data directory (working directory of the server), like the avatars folder
+SYNC_QUEUE_FILE = 'csi_sync_queue.json'
+
+
+
+class SyncWorker():
+    ''' Uploads payloads in a background greenlet, so event handlers never wait for the network
+
+    - jobs sharing a key are coalesced: only the latest payload is uploaded, after the jobs queued before it
+    - failed uploads are retried with exponential backoff, in order
+    - the queue is bounded: when it is full the oldest job with a key is dropped (a newer payload replaces it),
+      jobs without a key are never dropped
+    - the queue is saved to disk by the worker, so it survives a restart
+    - on_sent(action, payload) is called when a job is uploaded, on_drop(action, payload) when it is dropped
+    - send_fn(action, payload) performs the upload and returns the response text,
+      so the endpoint can be replaced (e.g. by a local stand-in server)
+    '''
+
+    def __init__(self, send_fn, on_response=None, can_send=None, on_failure=None, on_sent=None, on_drop=None,
+                 queue_file=SYNC_QUEUE_FILE, max_size=256, base_delay=2, max_delay=300):
+        self._send = send_fn
+        self._on_response = on_response
+        self._can_send = can_send
+        self._on_failure = on_failure
+        self._on_sent = on_sent
+        self._on_drop = on_drop
+        self._queue_file = queue_file
+        self._max_size = max_size
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._queue = OrderedDict()  # key -> {action, payload, attempts, next_try}
+        self._wakeup = Event()
+        self._greenlet = None
+        self._sequence = 0
+        self._dirty = False  # queue changed since it was saved
+        self._sending = None  # (key, job) being uploaded
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self._load()
+
+    def start(self):
+        if not self._greenlet:
+            self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        # pending jobs are kept (and saved), they are uploaded when the worker starts again
+        if self._greenlet:
+            self._greenlet.kill()
+            self._greenlet = None
+        if self._sending:
+            self._requeue(*self._sending)
+            self._sending = None
+        if self._dirty:
+            self._save()
+
+    def enqueue(self, action, payload, key=None):
+        # without a key every job is uploaded, with a key the latest payload wins
+        if key is None:
+            self._sequence += 1
+            key = f"{action}:{time.time()}:{self._sequence}"
+            coalesce = False
+        else:
+            key = f"{action}:{key}"
+            coalesce = True
+
+        if key in self._queue:
+            self.coalesced += 1
+            # the new payload goes after the jobs queued since the previous one (e.g. a clear of the event)
+            self._queue.move_to_end(key)
+        self._queue[key] = {
+            'action': action,
+            'payload': payload,
+            'coalesce': coalesce,
+            'attempts': 0,
+            'next_try': 0
+        }
+
+        if len(self._queue) > self._max_size:
+            self._drop_oldest()
+
+        # saved by the worker, so bursts of jobs are written once and handlers don't wait for the disk
+        self._dirty = True
+        self._wakeup.set()
+
+    def _drop_oldest(self):
+        dropped_key = next((key for key, job in self._queue.items() if job.get('coalesce')), None)
+        if dropped_key is None:
+            # jobs without a key can't be replaced by a newer payload: the queue grows instead
+            logger.error(f"Sync queue is full ({len(self._queue)} jobs), no job can be dropped")
+            return
+        job = self._queue.pop(dropped_key)
+        self.dropped += 1
+        logger.warning(f"Sync queue is full, dropping {dropped_key}")
+        if self._on_drop:
+            self._on_drop(job['action'], job['payload'])
+
+    def _run(self):
+        while True:
+            if self._dirty:
+                self._save()
+
+            if not self._queue:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            key, job = next(iter(self._queue.items()))
+            delay = job['next_try'] - time.time()
+            if delay > 0:
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+                continue
+
+            if self._can_send and not self._can_send():
+                # offline: keep the job and check again later
+                self._wakeup.wait(self._base_delay)
+                self._wakeup.clear()
+                continue
+
+            # the job leaves the queue while it is uploaded, a newer payload with the same key may replace it
+            del self._queue[key]
+            self._sending = (key, job)
+            try:
+                text = self._send(job['action'], job['payload'])
+                self.sent += 1
+                if self._on_sent:
+                    self._on_sent(job['action'], job['payload'])
+                if self._on_response:
+                    self._on_response(text)
+            except Exception as e:
+                self.failed += 1
+                job['attempts'] += 1
+                backoff = min(self._max_delay, self._base_delay * 2 ** (job['attempts'] - 1))
+                job['next_try'] = time.time() + backoff * random.uniform(0.8, 1.2)
+                logger.warning(f"Upload of {key} failed ({e}), retrying in {backoff} s")
+                if self._on_failure:
+                    self._on_failure(e)
+                self._requeue(key, job)
+            self._sending = None
+            self._dirty = True
+
+    def _requeue(self, key, job):
+        # back in front of the queue, unless a newer payload replaced it
+        if key not in self._queue:
+            self._queue[key] = job
+            self._queue.move_to_end(key, last=False)
+            self._dirty = True
+
+    def _load(self):
+        try:
+            if os.path.exists(self._queue_file):
+                with open(self._queue_file, 'r') as file:
+                    for key, job in json.load(file):
+                        job['next_try'] = 0
+                        self._queue[key] = job
+                logger.info(f"Restored {len(self._queue)} pending uploads")
+        except Exception as e:
+            logger.warning(f"Unable to restore pending uploads from {self._queue_file} ({e})")
+
+    def _save(self):
+        self._dirty = False
+        try:
+            with open(self._queue_file, 'w') as file:
+                json.dump(list(self._queue.items()), file)
+        except Exception as e:
+            logger.warning(f"Unable to save pending uploads to {self._queue_file} ({e})")
+
+    def stats(self):
+        return {
+            'pending': len(self._queue),
+            'sent': self.sent,
+            'failed': self.failed,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped
+        }
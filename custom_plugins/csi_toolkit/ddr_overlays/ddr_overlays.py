@@ -2,15 +2,26 @@
 
 import os
 import json
+import time
+import hashlib
 import logging
 import requests
-import zipfile
+from collections import deque
 
+from eventmanager import Evt
+from Database import ProgramMethod
 from RHUI import UIField, UIFieldType, UIFieldSelectOption
 
 from flask import jsonify, request, templating
 from flask.blueprints import Blueprint
 
+from ..cache_bus import bus
+from ..debounce import debounced
+from ..bracket_metadata import BRACKET_FORMATS, get_bracket_metadata, order_bracket_heats
+from ..class_rank_brackets.class_rank_brackets import get_race_leaderboard
+from .image_ingest import ImageIngest, AVATAR_SIZE, TEAM_LOGO_SIZE, PIL_AVAILABLE
+from .zip_import import ZipImport, MAX_ARCHIVE_SIZE
+
 logger = logging.getLogger(__name__)
 
 # Read the JSON file
@@ -47,11 +58,295 @@ except:
 PILOT_IMAGE_UPLOAD_FOLDER = 'shared/avatars'
 os.makedirs(PILOT_IMAGE_UPLOAD_FOLDER, exist_ok=True)
 TEAM_IMAGE_UPLOAD_FOLDER = 'plugins/csi_toolkit/ddr_overlays/static/imgs/teams'
+FLAG_IMAGE_FOLDER = 'plugins/csi_toolkit/ddr_overlays/static/imgs/flags'
 
 ALLOWED_IMAGE_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp"}
 def allowed_image(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_IMAGE_EXTENSIONS
 
+
+
+class ImageManifest():
+    ''' Images available to the overlays, listed once for every client
+
+    - folder name -> {file name: version}, the version (modification time) changes the URL when an image is replaced
+    - the listing is rebuilt after an upload, or when a folder changes on disk (e.g. files copied on the SD card)
+    '''
+
+    def __init__(self, folders):
+        self._folders = folders
+        self._manifest = None
+        self._etag = None
+        self._mtimes = None
+        self.builds = 0
+        self.requests = 0
+        self.not_modified = 0
+
+    def _folder_mtimes(self):
+        mtimes = dict()
+        for name, folder in self._folders.items():
+            try:
+                mtimes[name] = os.stat(folder).st_mtime_ns
+            except OSError:
+                mtimes[name] = None
+        return mtimes
+
+    def _list(self, folder):
+        images = dict()
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_file() and allowed_image(entry.name):
+                        images[entry.name] = int(entry.stat().st_mtime)
+        except OSError as e:
+            logger.warning(f"Unable to list images in {folder} ({e})")
+        return images
+
+    def invalidate(self):
+        # an image overwritten in place doesn't change the folder, so uploads invalidate explicitly
+        self._manifest = None
+
+    def get(self):
+        mtimes = self._folder_mtimes()
+        if self._manifest is None or mtimes != self._mtimes:
+            self._manifest = {name: self._list(folder) for name, folder in self._folders.items()}
+            self._etag = hashlib.sha1(json.dumps(self._manifest, sort_keys=True).encode('utf-8')).hexdigest()
+            self._mtimes = mtimes
+            self.builds += 1
+        return self._manifest, self._etag
+
+    def stats(self):
+        return {
+            'images': {name: len(images) for name, images in (self._manifest or {}).items()},
+            'etag': self._etag,
+            'builds': self.builds,
+            'requests': self.requests,
+            'not_modified': self.not_modified
+        }
+
+
+
+# Socket.IO namespace of the overlay state, separated from the one of the timer
+OVERLAY_NAMESPACE = '/ddr_overlays'
+
+# fields of the class leaderboards used by the overlays, the others are not sent
+OVERLAY_LEADERBOARD_FIELDS = [
+    'position', 'pilot_id', 'callsign', 'team_name', 'starts', 'points',
+    'laps', 'total_time', 'total_time_raw', 'total_time_laps', 'total_time_laps_raw',
+    'average_lap', 'average_lap_raw', 'fastest_lap', 'fastest_lap_raw', 'fastest_lap_source',
+    'consecutives', 'consecutives_raw', 'consecutives_base', 'consecutives_source'
+]
+
+# events changing pilots, heats, classes or results shown by the overlays
+OVERLAY_EVENTS = [
+    Evt.PILOT_ADD, Evt.PILOT_ALTER, Evt.PILOT_DELETE,
+    Evt.HEAT_ADD, Evt.HEAT_ALTER, Evt.HEAT_DELETE, Evt.HEAT_GENERATE,
+    Evt.CLASS_ADD, Evt.CLASS_DUPLICATE, Evt.CLASS_ALTER, Evt.CLASS_DELETE,
+    Evt.LAPS_SAVE, Evt.LAPS_RESAVE, Evt.ROUNDS_RESET, Evt.DATABASE_RESET
+]
+
+
+
+class OverlayState():
+    ''' View models of the overlays, computed once per change and shared by every OBS source
+
+    - the state has three sections (pilots, classes, heats), each one a dict id -> view model
+    - a client receives the full state when it connects, then only the entries that changed
+    - messages are JSON text numbered by `seq`: a client missing one asks for the full state again
+    - without connected overlays nothing is built: the state is marked stale and built on the next connection
+    '''
+
+    SECTIONS = ['pilots', 'classes', 'heats']
+
+    def __init__(self, rhapi, history_size=20):
+        self._rhapi = rhapi
+        self._socket = None
+        self._state = None
+        self._snapshot = None  # full state serialized, built on the first request after a change
+        self.seq = 0
+        self.clients = 0
+        self.updates = 0
+        self.skipped = 0  # refreshes without connected overlays
+        self.snapshots = 0
+        self.bytes_sent = 0
+        self.history = deque(maxlen=history_size)
+
+    def attach(self, socket):
+        self._socket = socket
+        socket.on_event('connect', self.on_connect, namespace=OVERLAY_NAMESPACE)
+        socket.on_event('disconnect', self.on_disconnect, namespace=OVERLAY_NAMESPACE)
+        socket.on_event('overlay_state_load', self.send_snapshot, namespace=OVERLAY_NAMESPACE)
+
+    def build_pilots(self):
+        pilots = dict()
+        for pilot in self._rhapi.db.pilots:
+            pilots[pilot.id] = {
+                'pilot_id': pilot.id,
+                'callsign': pilot.callsign,
+                'team_name': pilot.team,
+                'country': self._rhapi.db.pilot_attribute_value(pilot.id, 'country') or None
+            }
+        return pilots
+
+    def build_classes(self):
+        classes = dict()
+        for raceclass in self._rhapi.db.raceclasses:
+            metadata = get_bracket_metadata(self._rhapi, raceclass)
+            heats = order_bracket_heats(self._rhapi.db.heats_by_class(raceclass.id), metadata)
+
+            results = self._rhapi.db.raceclass_results(raceclass)
+            leaderboard = None
+            if results:
+                primary = results['meta']['primary_leaderboard']
+                leaderboard = {
+                    'meta': results['meta'],
+                    primary: [{field: row.get(field) for field in OVERLAY_LEADERBOARD_FIELDS} for row in results[primary]]
+                }
+
+            classes[raceclass.id] = {
+                'id': raceclass.id,
+                'name': raceclass.name,
+                'displayname': raceclass.display_name,
+                'bracket_format': metadata['format'] if metadata else None,
+                'heats': [heat.id if heat else None for heat in heats],
+                'ranking': raceclass.ranking or False,
+                'leaderboard': leaderboard
+            }
+        return classes
+
+    def build_heats(self):
+        leaderboards = dict()  # heat id -> leaderboard of Round 1
+
+        def heat_leaderboard(heat_id):
+            if heat_id not in leaderboards:
+                races = self._rhapi.db.races_by_heat(heat_id)
+                leaderboards[heat_id] = get_race_leaderboard(self._rhapi, races[0]) if races else None
+            return leaderboards[heat_id]
+
+        heats = dict()
+        for heat in self._rhapi.db.heats:
+            slots = []
+            for slot in self._rhapi.db.slots_by_heat(heat.id):
+                if not slot.seed_rank:
+                    continue
+                pilot_id = slot.pilot_id
+                if not pilot_id and slot.method == ProgramMethod.HEAT_RESULT:
+                    # seeded from a heat already raced: resolve the pilot here, so brackets are complete
+                    for row in heat_leaderboard(slot.seed_id) or []:
+                        if row['position'] == slot.seed_rank:
+                            pilot_id = row['pilot_id']
+                            break
+                slots.append({
+                    'pilot_id': pilot_id,
+                    'method': int(slot.method),
+                    'seed_id': slot.seed_id,
+                    'seed_rank': slot.seed_rank
+                })
+
+            heats[heat.id] = {
+                'id': heat.id,
+                'displayname': heat.display_name,
+                'class_id': heat.class_id,
+                'slots': slots
+            }
+        return heats
+
+    def build(self):
+        return {
+            'pilots': self.build_pilots(),
+            'classes': self.build_classes(),
+            'heats': self.build_heats()
+        }
+
+    def diff(self, old, new):
+        changed = dict()
+        removed = dict()
+        for section in self.SECTIONS:
+            previous = old.get(section, {})
+            current = new[section]
+            entries = {key: value for key, value in current.items() if previous.get(key) != value}
+            if entries:
+                changed[section] = entries
+            gone = [key for key in previous if key not in current]
+            if gone:
+                removed[section] = gone
+        return changed, removed
+
+    def serialize(self, message):
+        return json.dumps(message, separators=(',', ':'), default=str)
+
+    def refresh(self, args=None):
+        if not self.clients:
+            # nobody to update: drop the state, get_snapshot() builds it when an overlay connects
+            if self._state is not None:
+                self.seq += 1
+                self._state = None
+                self._snapshot = None
+            self.skipped += 1
+            return
+
+        start = time.perf_counter()
+        state = self.build()
+        build_time = time.perf_counter() - start
+
+        changed, removed = self.diff(self._state or {}, state)
+        self._state = state
+        if not changed and not removed:
+            return
+
+        self.seq += 1
+        self._snapshot = None
+        start = time.perf_counter()
+        payload = self.serialize({'seq': self.seq, 'full': False, 'set': changed, 'remove': removed})
+        serialize_time = time.perf_counter() - start
+
+        # serialized once, then the same text is sent to every connected overlay
+        if self._socket and self.clients:
+            self._socket.emit('overlay_state', payload, namespace=OVERLAY_NAMESPACE)
+            self.bytes_sent += len(payload) * self.clients
+
+        self.updates += 1
+        self.history.append({
+            'seq': self.seq,
+            'entries': sum(len(entries) for entries in changed.values()) + sum(len(keys) for keys in removed.values()),
+            'bytes': len(payload),
+            'clients': self.clients,
+            'build_ms': round(build_time * 1000, 2),
+            'serialize_ms': round(serialize_time * 1000, 2)
+        })
+
+    def get_snapshot(self):
+        if self._state is None:
+            self._state = self.build()
+        if self._snapshot is None:
+            self._snapshot = self.serialize(dict(self._state, seq=self.seq, full=True))
+        return self._snapshot
+
+    def send_snapshot(self, data=None):
+        snapshot = self.get_snapshot()
+        self._socket.emit('overlay_state', snapshot, namespace=OVERLAY_NAMESPACE, to=request.sid)
+        self.snapshots += 1
+        self.bytes_sent += len(snapshot)
+
+    def on_connect(self, auth=None):
+        self.clients += 1
+        self.send_snapshot()
+
+    def on_disconnect(self, reason=None):
+        self.clients = max(0, self.clients - 1)
+
+    def stats(self):
+        return {
+            'seq': self.seq,
+            'clients': self.clients,
+            'updates': self.updates,
+            'skipped': self.skipped,
+            'snapshots': self.snapshots,
+            'snapshot_bytes': len(self._snapshot) if self._snapshot else None,
+            'bytes_sent': self.bytes_sent,
+            'history': list(self.history)
+        }
+
 def initialize(rhapi):
     rhapi.fields.register_pilot_attribute( country_ui_field )
     if custom_teams:
@@ -62,6 +357,45 @@ def initialize(rhapi):
     else:
         rhapi.fields.register_pilot_attribute( team_ui_field )
 
+    overlay_state = OverlayState(rhapi)
+    try:
+        # private attribute: RHAPI only broadcasts on the default namespace (ui.socket_broadcast),
+        # the Flask-SocketIO instance is needed to serve a namespace of our own
+        overlay_state.attach(rhapi._racecontext.rhui._socket)
+    except Exception as e:
+        logger.warning(f"Unable to open the {OVERLAY_NAMESPACE} namespace, overlays won't receive updates ({e})")
+    bus.add_stats_provider('overlay_state', overlay_state.stats)
+
+    # one rebuild for a burst of changes (e.g. a generated bracket adds many heats)
+    refresh = debounced(bus, "ddr_overlays_state", overlay_state.refresh)
+    for event in OVERLAY_EVENTS:
+        rhapi.events.on(event, refresh)
+
+    image_manifest = ImageManifest({
+        'avatars': PILOT_IMAGE_UPLOAD_FOLDER,
+        'flags': FLAG_IMAGE_FOLDER,
+        'teams': TEAM_IMAGE_UPLOAD_FOLDER
+    })
+    bus.add_stats_provider('image_manifest', image_manifest.stats)
+
+    # uploads are resized to the overlay size and stored as WebP
+    avatar_ingest = ImageIngest(PILOT_IMAGE_UPLOAD_FOLDER, AVATAR_SIZE, crop=True)
+    team_ingest = ImageIngest(TEAM_IMAGE_UPLOAD_FOLDER, TEAM_LOGO_SIZE, crop=False)
+    bus.add_stats_provider('avatar_ingest', avatar_ingest.stats)
+    bus.add_stats_provider('team_ingest', team_ingest.stats)
+    if not PIL_AVAILABLE:
+        logger.warning("Pillow is not installed: uploaded images are stored without resizing")
+
+    def pilot_image_name(pilot_id, filename):
+        # avatars are named after the callsign, the file name is used for unknown pilots
+        try:
+            pilot = rhapi.db.pilot_by_id(int(pilot_id))
+            if pilot:
+                return pilot.callsign
+        except ValueError:
+            pass
+        return filename.rsplit(".", 1)[0]
+
     bp = Blueprint(
         'ddr_overlays',
         __name__,
@@ -70,6 +404,16 @@ def initialize(rhapi):
         static_url_path='/csi_toolkit/ddr_overlays/static'
     )
 
+    # embedded in every page by ddr_overlay_data.html
+    @bp.context_processor
+    def ddr_overlay_page_data():
+        manifest, etag = image_manifest.get()
+        return {'ddr_overlay_data': {
+            'bracket_formats': BRACKET_FORMATS,
+            'image_manifest': manifest,
+            'image_manifest_etag': etag
+        }}
+
     ### home page ###
     @bp.route('/ddr_overlays')
     def ddr_overlays_homePage():
@@ -139,6 +483,20 @@ def initialize(rhapi):
 
     ################################################
 
+    ### images available to the overlays ###
+    @bp.route('/ddr_overlays/image_manifest')
+    def ddr_overlays_imageManifest():
+        manifest, etag = image_manifest.get()
+        response = jsonify(manifest)
+        response.set_etag(etag)
+        # clients revalidate every time, unchanged manifests are answered with 304
+        response.cache_control.no_cache = True
+        response = response.make_conditional(request)
+        image_manifest.requests += 1
+        if response.status_code == 304:
+            image_manifest.not_modified += 1
+        return response
+
     ### upload pilot image ###
     @bp.route("/upload_pilot_image", methods=["POST"])
     def upload_pilot_image():
@@ -161,57 +519,61 @@ def initialize(rhapi):
         if size > 10 * 1024 * 1024:
             return jsonify({"error": "file too big (more than 10 MB)"}), 400
 
-        filename = file.filename
-        filepath = os.path.join(PILOT_IMAGE_UPLOAD_FOLDER, filename)
-        file.seek(0)
-        file.save(filepath)
+        try:
+            result = avatar_ingest.ingest(file.read(), pilot_image_name(pilot_id, file.filename), file.filename)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        finally:
+            avatar_ingest.save_hashes()
+        image_manifest.invalidate()
 
         # public URL to get the image
-        file_url = filepath
+        file_url = os.path.join(PILOT_IMAGE_UPLOAD_FOLDER, result["file"])
 
-        return jsonify({"success": True, "new_url": file_url})
+        return jsonify({"success": True, "new_url": file_url, "status": result["status"]})
 
     ### upload pilot image bulk ###
+    # a zip sent as request body (application/zip) is imported while it is uploaded,
+    # a zip sent as form file (field "zipfile") once the upload is complete
     @bp.route("/upload_zip", methods=["POST"])
     def upload_zip():
-        if "zipfile" not in request.files:
-            return jsonify({"error": "no file"}), 400
+        if request.mimetype == "application/zip":
+            stream = request.stream
+            total_bytes = request.content_length
+            filename = request.args.get("filename", "upload.zip")
+        else:
+            if "zipfile" not in request.files:
+                return jsonify({"error": "no file"}), 400
 
-        zip_file = request.files["zipfile"]
+            zip_file = request.files["zipfile"]
 
-        if zip_file.filename == "":
-            return jsonify({"error": "empty filename"}), 400
+            if zip_file.filename == "":
+                return jsonify({"error": "empty filename"}), 400
 
-        # size check
-        zip_file.seek(0, os.SEEK_END)
-        size = zip_file.tell()
-        zip_file.seek(0)
-        if size > 100 * 1024 * 1024:
-            return jsonify({"error": "ZIP file too big (more than 100 MB)"}), 400
+            stream = zip_file.stream
+            total_bytes = None
+            filename = zip_file.filename
 
-        # temporary path
-        temp_path = os.path.join(PILOT_IMAGE_UPLOAD_FOLDER, "temp_upload.zip")
-        zip_file.save(temp_path)
+        # size check
+        if total_bytes and total_bytes > MAX_ARCHIVE_SIZE:
+            return jsonify({"error": f"ZIP file too big (more than {MAX_ARCHIVE_SIZE // (1024 * 1024)} MB)"}), 400
 
-        # extraction
-        try:
-            with zipfile.ZipFile(temp_path, 'r') as zip_ref:
-                for member in zip_ref.namelist():
-                    # avoid path traversal such as "../../"
-                    if not os.path.basename(member) == member:
-                        os.remove(temp_path)
-                        return jsonify({"error": "ZIP file contains subfolders or invalid paths"}), 400
+        def report_progress(progress):
+            rhapi.ui.socket_broadcast("ddr_avatar_import", dict(progress, filename=filename))
 
-                # extract only valid files
-                zip_ref.extractall(PILOT_IMAGE_UPLOAD_FOLDER)
-        except zipfile.BadZipFile:
-            os.remove(temp_path)
-            return jsonify({"error": "file is not a valid ZIP"}), 400
+        summary = ZipImport(avatar_ingest, allowed_image, report_progress).run(stream, total_bytes)
+        image_manifest.invalidate()
 
-        # remove the temporary archive
-        os.remove(temp_path)
+        if summary["error"] and not summary["files"]:
+            return jsonify({"error": summary["error"]}), 400
 
-        return jsonify({"success": True, "message": "ZIP uploaded successfully"})
+        logger.info(f"Imported {filename} in {summary['elapsed_ms']} ms: {summary['counts']}")
+        message = "ZIP uploaded successfully" if not summary["error"] else f"ZIP partially imported: {summary['error']}"
+        counts = ", ".join(f"{count} {status}" for status, count in summary["counts"].items())
+        if counts:
+            message += f" ({counts})"
+        return jsonify({"success": not summary["error"], "message": message, "files": summary["files"],
+                        "counts": summary["counts"], "elapsed_ms": summary["elapsed_ms"]})
 
     ### get teams ###
     @bp.route("/get_teams")
@@ -239,15 +601,18 @@ def initialize(rhapi):
         if size > 10 * 1024 * 1024:
             return jsonify({"error": "file too big (more than 10 MB)"}), 400
 
-        filename = file.filename
-        filepath = os.path.join(TEAM_IMAGE_UPLOAD_FOLDER, filename)
-        file.seek(0)
-        file.save(filepath)
+        try:
+            result = team_ingest.ingest(file.read(), file.filename.rsplit(".", 1)[0], file.filename)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        finally:
+            team_ingest.save_hashes()
+        image_manifest.invalidate()
 
         # public URL to get the image
-        file_url = filepath
+        file_url = os.path.join(TEAM_IMAGE_UPLOAD_FOLDER, result["file"])
 
-        return jsonify({"success": True, "new_url": file_url})
+        return jsonify({"success": True, "new_url": file_url, "status": result["status"]})
 
     rhapi.ui.blueprint_add(bp)
 
@@ -0,0 +1,178 @@
+''' Uploaded images resized to the overlay size and stored as WebP '''
+
+import io
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Pillow is optional: without it images are stored as uploaded
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# larger images are refused before being decoded
+MAX_IMAGE_PIXELS = 50 * 1000 * 1000
+if PIL_AVAILABLE:
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+AVATAR_SIZE = (595, 814)     # avatars are cropped to this size
+TEAM_LOGO_SIZE = (256, 256)  # team logos are scaled to fit in this box
+WEBP_QUALITY = 85
+
+INGEST_HASHES_FILE = '.ingest_hashes.json'
+
+
+
+def normalized_name(name):
+    # same naming convention of the overlays: lowercase, spaces (and path separators) replaced by underscores
+    name = name.strip()
+    for character in [' ', '/', '\\', '\0']:
+        name = name.replace(character, '_')
+    return name.lower()
+
+
+
+def normalize_image(data, size, crop, quality=WEBP_QUALITY):
+    ''' Decode an image, resize it and encode it as WebP, returns the encoded bytes
+
+    With crop the image fills `size` (the center is kept), otherwise it is scaled to fit in `size`.
+    Kept at module level, so it can run in a thread pool.
+    '''
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG can be decoded directly at a reduced scale, much faster than a full decode
+        image.draft('RGB', (size[0] * 2, size[1] * 2))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+        if crop:
+            image = ImageOps.fit(image, size, Image.LANCZOS)
+        else:
+            image.thumbnail(size, Image.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, 'WEBP', quality=quality, method=4)
+        return output.getvalue()
+
+
+
+def try_normalize_image(data, size, crop):
+    # returns (output, error): thread pools print the traceback of every exception raised in a task
+    try:
+        return normalize_image(data, size, crop), None
+    except UnidentifiedImageError:
+        return None, "unknown format"
+    except Exception as e:
+        return None, str(e)
+
+
+
+class ImageIngest():
+    ''' Stores the images uploaded to a folder under the normalized name, as WebP of the overlay size
+
+    - the hash of each source image is kept in the folder: uploading the same image again is skipped,
+      hashes are written by save_hashes(), once per request or import
+    - without Pillow the upload is stored as is, with its original extension
+    '''
+
+    def __init__(self, folder, size, crop):
+        self.folder = folder
+        self.size = size
+        self.crop = crop
+        self._hashes_file = os.path.join(folder, INGEST_HASHES_FILE)
+        self._hashes = self._load_hashes()
+        self._hashes_changed = False
+        self.saved = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _load_hashes(self):
+        try:
+            if os.path.exists(self._hashes_file):
+                with open(self._hashes_file, 'r') as file:
+                    return json.load(file)
+        except Exception as e:
+            logger.warning(f"Unable to read image hashes from {self._hashes_file} ({e})")
+        return dict()
+
+    def save_hashes(self):
+        if not self._hashes_changed:
+            return
+        self._hashes_changed = False
+        try:
+            with open(self._hashes_file, 'w') as file:
+                json.dump(self._hashes, file)
+        except Exception as e:
+            logger.warning(f"Unable to save image hashes to {self._hashes_file} ({e})")
+
+    def target(self, name, filename):
+        ''' Returns (file name, output settings) of an upload named `name`, raises ValueError if the name is invalid '''
+        stem = normalized_name(name)
+        if not stem or stem.startswith('.'):
+            # hidden files (e.g. the hashes file) can't be replaced
+            raise ValueError(f"invalid name \"{name}\"")
+        if PIL_AVAILABLE:
+            target, settings = stem + '.webp', f"{self.size[0]}x{self.size[1]}:{int(self.crop)}:{WEBP_QUALITY}"
+        else:
+            extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+            target, settings = f"{stem}.{extension if extension.isalnum() else 'webp'}", 'original'
+        self.path(target)
+        return target, settings
+
+    def path(self, target):
+        # the file must stay in the folder, whatever the name of the upload
+        folder = os.path.realpath(self.folder)
+        path = os.path.realpath(os.path.join(folder, target))
+        if os.path.dirname(path) != folder:
+            raise ValueError(f"invalid name \"{target}\"")
+        return path
+
+    def is_unchanged(self, target, digest):
+        return self._hashes.get(target) == digest and os.path.exists(self.path(target))
+
+    def store(self, target, digest, data, size_in):
+        with open(self.path(target), 'wb') as file:
+            file.write(data)
+        self._hashes[target] = digest
+        self._hashes_changed = True
+        self.saved += 1
+        self.bytes_in += size_in
+        self.bytes_out += len(data)
+
+    def ingest(self, data, name, filename='', run=None):
+        ''' Returns {file, status} where status is "saved" or "unchanged", raises ValueError if the image is invalid
+
+        run(fn, args), if given, runs the resize elsewhere (e.g. in a thread pool)
+        '''
+        target, settings = self.target(name, filename or name)
+        # the settings are part of the hash, so a different overlay size encodes the images again
+        digest = hashlib.sha256(data).hexdigest() + ':' + settings
+        if self.is_unchanged(target, digest):
+            self.unchanged += 1
+            return {'file': target, 'status': 'unchanged'}
+
+        output = data
+        if PIL_AVAILABLE:
+            args = (data, self.size, self.crop)
+            output, error = run(try_normalize_image, args) if run else try_normalize_image(*args)
+            if error:
+                self.failed += 1
+                raise ValueError(f"invalid image ({error})")
+
+        self.store(target, digest, output, len(data))
+        return {'file': target, 'status': 'saved'}
+
+    def stats(self):
+        return {
+            'pillow': PIL_AVAILABLE,
+            'saved': self.saved,
+            'unchanged': self.unchanged,
+            'failed': self.failed,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out
+        }
@@ -138,27 +138,75 @@ default_handler = {
 
 /* Format-related functions */
 function get_number_of_pilots_from_format(bracket_type) {
-    var format_8 = ['ddr8de'];
-    if (format_8.includes(bracket_type)) {
-        return 8;
+    if (bracket_format_registry[bracket_type] != undefined) {
+        return bracket_format_registry[bracket_type].pilots;
     }
 
-    var format_16 = ['multigp16', 'fai16', 'fai16de'];
-    if (format_16.includes(bracket_type)) {
-        return 16;
-    }
+    return 999;
+}
 
-    var format_32 = ['fai32', 'fai32de'];
-    if (format_32.includes(bracket_type)) {
-        return 32;
-    }
 
-    var format_64 = ['fai64', 'fai64de'];
-    if (format_64.includes(bracket_type)) {
-        return 64;
-    }
 
-    return 999;
+/* Overlay state: pilots, classes and heats computed once by the server for every overlay.
+ * The full state is received on connect, then only the entries that changed */
+function overlay_state_connect(on_update) {
+    var overlay_state = {seq: 0, pilots: {}, classes: {}, heats: {}};
+    var received = false;
+    var overlay_socket = io('/ddr_overlays');
+
+    overlay_socket.on('overlay_state', function (text) {
+        var msg = JSON.parse(text);
+        if (msg.full) {
+            overlay_state = {seq: msg.seq, pilots: msg.pilots, classes: msg.classes, heats: msg.heats};
+        } else if (msg.seq <= overlay_state.seq) {
+            return;
+        } else if (msg.seq > overlay_state.seq + 1) {
+            // an update was missed: ask for the full state again
+            overlay_socket.emit('overlay_state_load');
+            return;
+        } else {
+            for (var section in msg.set) {
+                Object.assign(overlay_state[section], msg.set[section]);
+            }
+            for (var section in msg.remove) {
+                msg.remove[section].forEach(key => delete overlay_state[section][key]);
+            }
+            overlay_state.seq = msg.seq;
+        }
+        received = true;
+        on_update(overlay_state);
+    });
+
+    // the overlay state is not part of the page data: draw the last state again with the new images
+    on_image_manifest_change(function () {
+        if (received) {
+            on_update(overlay_state);
+        }
+    });
+
+    return overlay_socket;
+}
+
+function overlay_pilot_list(overlay_state) {
+    return Object.values(overlay_state.pilots);
+}
+
+/* results of a class, undefined if none of its heats has been raced */
+function overlay_class_leaderboard(overlay_state, class_id) {
+    var current_class = overlay_state.classes[class_id];
+    if (!current_class) {
+        return undefined;
+    }
+    if (current_class.ranking) {
+        // ranking other than "From Race Format"
+        return {'class': current_class, 'leaderboard': current_class.ranking.ranking, 'display_type': 'by_race_time', 'meta': undefined};
+    }
+    if (current_class.leaderboard && current_class.leaderboard[current_class.leaderboard.meta.primary_leaderboard].length) {
+        // ranking equal to "From Race Format"
+        var meta = current_class.leaderboard.meta;
+        return {'class': current_class, 'leaderboard': current_class.leaderboard[meta.primary_leaderboard], 'display_type': meta.primary_leaderboard, 'meta': meta};
+    }
+    return undefined;
 }
 
 
@@ -543,13 +591,63 @@ function build_results(leaderboard, display_type='by_race_time', meta={}, number
 
 
 
+/* Images available on the server (avatars, flags, team logos): image URLs are resolved without requests.
+ * The manifest is embedded in the page (ddr_overlay_data.html), then revalidated in background (304 if unchanged):
+ * when it changes the page is drawn again */
+const IMAGE_MANIFEST_URL = '/ddr_overlays/image_manifest';
+const IMAGE_MANIFEST_REFRESH = 60000;  // ms
+
+var image_manifest = ddr_overlay_data.image_manifest;
+var image_manifest_etag = ddr_overlay_data.image_manifest_etag;
+var image_manifest_listeners = [];
+
+/* fn() is called when images are added, replaced or removed */
+function on_image_manifest_change(fn) {
+    image_manifest_listeners.push(fn);
+}
+
+function refresh_image_manifest(callback) {
+    $.ajax({
+        url: IMAGE_MANIFEST_URL,
+        dataType: 'json',
+        success: function (manifest, status, xhr) {
+            let etag = (xhr.getResponseHeader('ETag') || '').replace(/^W\//, '').replace(/"/g, '');
+            if (etag != image_manifest_etag) {
+                image_manifest = manifest;
+                image_manifest_etag = etag;
+                image_manifest_listeners.forEach(fn => fn());
+            }
+            if (callback) {
+                callback();
+            }
+        }
+    });
+}
+
+setInterval(refresh_image_manifest, IMAGE_MANIFEST_REFRESH);
+
+/* the data of the page is sent again by the server, so its handlers draw the new images */
+on_image_manifest_change(function () {
+    if (typeof(socket) !== 'undefined' && typeof(data_dependencies) !== 'undefined') {
+        socket.emit('load_data', {'load_types': data_dependencies});
+    }
+});
+
+function imageURL(folder, base_url, filename, default_url) {
+    let version = image_manifest[folder][filename];
+    if (version === undefined) {
+        return default_url;
+    }
+    // the version changes when the image is replaced, so the browser doesn't show the old one
+    return base_url + filename + '?v=' + version;
+}
+
+
+
 /* Pilot data retrieval */
 function getFlagURL(pilot_id, ddr_pilot_data) {
-    let flagImg = '/csi_toolkit/ddr_overlays/static/imgs/flags/' + getPilotFlag(pilot_id, ddr_pilot_data) + '.png';
-    if (!imageExists(flagImg)) {
-        flagImg = '/csi_toolkit/ddr_overlays/static/imgs/flags/it.png';
-    }
-    return flagImg;
+    return imageURL('flags', '/csi_toolkit/ddr_overlays/static/imgs/flags/', getPilotFlag(pilot_id, ddr_pilot_data) + '.png',
+                    '/csi_toolkit/ddr_overlays/static/imgs/flags/it.png');
 }
 
 function getPilotFlag(pilot_id, ddr_pilot_data) {
@@ -569,26 +667,16 @@ function getPilotFlag(pilot_id, ddr_pilot_data) {
 }
 
 function getPilotImgURL(pilot) {
-    let pilotImg = '/shared/avatars/' + pilot.callsign.replace(/ /g,"_").toLowerCase() + '.webp';
-    if (!imageExists(pilotImg)) {
-        pilotImg = '/csi_toolkit/ddr_overlays/static/imgs/no_avatar.png';
-    }
-    return pilotImg;
+    return imageURL('avatars', '/shared/avatars/', pilot.callsign.trim().replace(/[ \/\\]/g,"_").toLowerCase() + '.webp',
+                    '/csi_toolkit/ddr_overlays/static/imgs/no_avatar.png');
 }
 
 function getTeamImgURL(team) {
-    let teamImg = '/csi_toolkit/ddr_overlays/static/imgs/teams/' + team?.replace(/ /g,"_").toLowerCase() + '.png';
-    if (!imageExists(teamImg)) {
-        teamImg = '/csi_toolkit/ddr_overlays/static/imgs/no_team.png';
-    }
-    return teamImg;
-}
-
-function imageExists(image_url) {
-    var http = new XMLHttpRequest();
-    http.open('HEAD', image_url, false);
-    http.send();
-    return http.status != 404;
+    // uploaded logos are stored as WebP, logos copied by hand may still be PNG
+    let team_name = team?.trim().replace(/[ \/\\]/g,"_").toLowerCase();
+    return imageURL('teams', '/csi_toolkit/ddr_overlays/static/imgs/teams/', team_name + '.webp',
+                    imageURL('teams', '/csi_toolkit/ddr_overlays/static/imgs/teams/', team_name + '.png',
+                             '/csi_toolkit/ddr_overlays/static/imgs/no_team.png'));
 }
 
 
@@ -619,125 +707,50 @@ class BracketHeat {
     }
 }
 
-const bracket_formats = {
-    "ddr8de":    [
-                   new BracketHeat(1,  "preliminary", 0, 4),
-                   new BracketHeat(2,  "preliminary", 0, 4),
-                   new BracketHeat(3,  "loser",       0, 5),
-                   new BracketHeat(4,  "winner",      1, 6),
-                   new BracketHeat(5,  "loser",       1, 6),
-                   new BracketHeat(6,  "winner",      2),
-                 ],
-    "multigp16": [
-                   new BracketHeat(1,  "preliminary", 0, 6),
-                   new BracketHeat(2,  "preliminary", 0, 6),
-                   new BracketHeat(3,  "preliminary", 0, 8),
-                   new BracketHeat(4,  "preliminary", 0, 8),
-                   new BracketHeat(5,  "loser",       0, 9),
-                   new BracketHeat(6,  "winner",      1, 11),
-                   new BracketHeat(7,  "loser",       0, 10),
-                   new BracketHeat(8,  "winner",      1, 11),
-                   new BracketHeat(9,  "loser",       1, 12),
-                   new BracketHeat(10, "loser",       1, 12),
-                   new BracketHeat(11, "winner",      2, 14),
-                   new BracketHeat(12, "loser",       2, 13),
-                   new BracketHeat(13, "loser",       3, 14),
-                   new BracketHeat(14, "winner",      3),
-                 ],
-    //"fai16":     [],
-    "fai16de":   [
-                   new BracketHeat(1,  "preliminary", 0),
-                   new BracketHeat(2,  "preliminary", 0),
-                   new BracketHeat(3,  "preliminary", 0),
-                   new BracketHeat(4,  "preliminary", 0),
-                   new BracketHeat(5,  "loser",       0),
-                   new BracketHeat(6,  "loser",       0),
-                   new BracketHeat(7,  "winner",      1),
-                   new BracketHeat(8,  "winner",      1),
-                   new BracketHeat(9,  "loser",       1),
-                   new BracketHeat(10, "loser",       1),
-                   new BracketHeat(11, "loser",       2),
-                   new BracketHeat(12, "winner",      2),
-                   new BracketHeat(13, "loser",       3),
-                   new BracketHeat(14, "winner",      3),
-                 ],
-    //"fai32":     [],
-    "fai32de":   [
-                   new BracketHeat(1,  "preliminary", 0),
-                   new BracketHeat(2,  "preliminary", 0),
-                   new BracketHeat(3,  "preliminary", 0),
-                   new BracketHeat(4,  "preliminary", 0),
-                   new BracketHeat(5,  "preliminary", 1),
-                   new BracketHeat(6,  "preliminary", 1),
-                   new BracketHeat(7,  "preliminary", 1),
-                   new BracketHeat(8,  "preliminary", 1),
-                   new BracketHeat(9,  "winner",      2),
-                   new BracketHeat(10, "winner",      2),
-                   new BracketHeat(11, "winner",      2),
-                   new BracketHeat(12, "winner",      2),
-                   new BracketHeat(13, "loser",       0),
-                   new BracketHeat(14, "loser",       0),
-                   new BracketHeat(15, "loser",       0),
-                   new BracketHeat(16, "loser",       0),
-                   new BracketHeat(17, "loser",       1),
-                   new BracketHeat(18, "loser",       1),
-                   new BracketHeat(19, "loser",       1),
-                   new BracketHeat(20, "loser",       1),
-                   new BracketHeat(21, "loser",       2),
-                   new BracketHeat(22, "loser",       2),
-                   new BracketHeat(23, "winner",      3),
-                   new BracketHeat(24, "winner",      3),
-                   new BracketHeat(25, "loser",       3),
-                   new BracketHeat(26, "loser",       3),
-                   new BracketHeat(27, "loser",       4),
-                   new BracketHeat(28, "winner",      4),
-                   new BracketHeat(29, "loser",       5),
-                   new BracketHeat(30, "winner",      5),
-                 ],
-    //"fai64":     [],
-    //"fai64de":   []
-}
+/* Bracket formats are shared with the ranking plugin through a single data file,
+ * the server embeds it in every overlay page (ddr_overlay_data.html) since it's needed before the first render */
+const bracket_format_registry = ddr_overlay_data.bracket_formats;
 
-function build_elimination_brackets(race_bracket_type, race_class_id, ddr_pilot_data, ddr_heat_data, ddr_class_data, ddr_race_data) {
+/* heat layout of each format with a bracket view, formats without layout are left undefined */
+const bracket_formats = {};
+Object.keys(bracket_format_registry).forEach(format_name => {
+    let heats = bracket_format_registry[format_name].heats;
+    if (heats.length > 0) {
+        bracket_formats[format_name] = heats.map((heat, i) => new BracketHeat(i+1, heat.type, heat.column, heat.advance_to));
+    }
+});
+
+function build_elimination_brackets(race_bracket_type, race_class_id, overlay_state) {
 
     // clear brackets
     $('#winner_bracket_content').html('');
     $('#loser_bracket_content').html('');
 
-    var elimination_heats = [];
+    const race_class = overlay_state.classes[race_class_id];
+    if (!race_class) {
+        return;
+    }
 
-    Object.values(ddr_heat_data).forEach(heat => {
-        if (heat.class_id == race_class_id) {
-            elimination_heats.push(heat);
-        }
-    });
+    // heats in bracket order, a heat removed from the class is null
+    const elimination_heats = race_class.heats;
+    const ddr_pilot_data = overlay_pilot_list(overlay_state);
 
     // loop through heats and build brackets
     console.log('There are ' + elimination_heats.length + ' heats');
 
     for (let i = 0; i < elimination_heats.length; i++) {
-        const heat = elimination_heats[i];
+        const heat = overlay_state.heats[elimination_heats[i]];
+        if (!heat) {
+            continue;
+        }
         let html = '<div class="bracket_race">';
         html += '<div class="bracket_race_title">' + heat.displayname + '</div>';
         html += '<div class="bracket_race_pilots">';
 
-        const filtered_slots = heat.slots.filter(slot => /*slot.seed_id*/true && slot.seed_rank);
-
-        for (let j = 0; j < filtered_slots.length; j++) {
-            const slot = filtered_slots[j];
-            let pilot;
-
-            if (slot.pilot_id === 0) {
-                // try to get the pilot from completed heats
-                if (slot.method == 1) {
-                    // heat
-                    const leaderboard_type = ddr_race_data.heats[slot.seed_id]?.leaderboard.meta.primary_leaderboard;
-                    pilot = ddr_race_data.heats[slot.seed_id]?.leaderboard[leaderboard_type].find(p => p.position === slot.seed_rank);
-                }
-            } else {
-                // pilot available
-                pilot = ddr_pilot_data.find(p => p.pilot_id === slot.pilot_id);
-            }
+        for (let j = 0; j < heat.slots.length; j++) {
+            const slot = heat.slots[j];
+            // pilots seeded from completed heats are already resolved by the server
+            const pilot = overlay_state.pilots[slot.pilot_id];
 
             if (pilot) {
                 let flagImg = getFlagURL(pilot.pilot_id, ddr_pilot_data);
@@ -752,7 +765,7 @@ function build_elimination_brackets(race_bracket_type, race_class_id, ddr_pilot_
 
                 html += '</div>';
             } else {
-                let method_text = get_method_descriptor(ddr_pilot_data, ddr_heat_data, ddr_class_data, slot.method, slot.seed_id, slot.seed_rank, slot.pilot_id)
+                let method_text = get_method_descriptor(overlay_state, slot.method, slot.seed_id, slot.seed_rank, slot.pilot_id)
                 html += '<div class="bracket_race_pilot">';
                 html += '<div class="no_pilot">' + method_text + '</div>';
                 html += '</div>';
@@ -782,9 +795,9 @@ function build_elimination_brackets(race_bracket_type, race_class_id, ddr_pilot_
     }
 }
 
-function get_method_descriptor(ddr_pilot_data, ddr_heat_data, ddr_class_data, method, seed, rank, pilot_id) {
+function get_method_descriptor(overlay_state, method, seed, rank, pilot_id) {
     if (method == 0) { // pilot
-        var pilot = ddr_pilot_data?.find(obj => {return obj.pilot_id == pilot_id});
+        var pilot = overlay_state.pilots[pilot_id];
 
         if (pilot) {
             return pilot.callsign;
@@ -792,7 +805,7 @@ function get_method_descriptor(ddr_pilot_data, ddr_heat_data, ddr_class_data, me
             return false;
         }
     } else if (method == 1) { // heat
-        var heat = ddr_heat_data?.find(obj => {return obj.id == seed});
+        var heat = overlay_state.heats[seed];
 
         if (heat) {
             return heat.displayname + " " + __('Rank') + " " + rank;
@@ -800,7 +813,7 @@ function get_method_descriptor(ddr_pilot_data, ddr_heat_data, ddr_class_data, me
             return false;
         }
     } else if (method == 2) { // class
-        var race_class = ddr_class_data?.find(obj => {return obj.id == seed});
+        var race_class = overlay_state.classes[seed];
 
         if (race_class) {
             return race_class.displayname + " " + __('Rank') + " " + rank;
@@ -0,0 +1,320 @@
+''' Avatar import from a zip archive, read while it is uploaded '''
+
+import os
+import time
+import zlib
+import struct
+import logging
+import gevent
+import gevent.pool
+import gevent.threadpool
+
+logger = logging.getLogger(__name__)
+
+LOCAL_FILE_HEADER = 0x04034b50
+DATA_DESCRIPTOR = 0x08074b50
+CENTRAL_DIRECTORY = 0x02014b50
+END_OF_CENTRAL_DIRECTORY = 0x06054b50
+
+STORED = 0
+DEFLATED = 8
+
+MAX_MEMBER_SIZE = 10 * 1024 * 1024    # same limit of a single upload
+MAX_ARCHIVE_SIZE = 100 * 1024 * 1024
+MAX_INFLATED_SIZE = 500 * 1024 * 1024  # bytes inflated from all the members, against zip bombs
+
+# images are resized in native threads: Pillow releases the GIL while decoding, resizing and encoding
+IMPORT_WORKERS = min(4, os.cpu_count() or 1)
+
+
+
+class StreamReader():
+    ''' Buffered reads of exact sizes from a non-seekable stream, with a limit on the bytes read '''
+
+    def __init__(self, stream, max_bytes=None, chunk_size=64 * 1024):
+        self._stream = stream
+        self._max_bytes = max_bytes
+        self._chunk_size = chunk_size
+        self._buffer = b''
+        self.bytes_read = 0
+
+    def read_chunk(self):
+        # buffered bytes first, then the next chunk of the stream (empty at the end)
+        if self._buffer:
+            chunk, self._buffer = self._buffer, b''
+            return chunk
+        chunk = self._stream.read(self._chunk_size)
+        self.bytes_read += len(chunk)
+        if self._max_bytes and self.bytes_read > self._max_bytes:
+            raise ValueError(f"ZIP file too big (more than {self._max_bytes // (1024 * 1024)} MB)")
+        return chunk
+
+    def unread(self, data):
+        self._buffer = data + self._buffer
+
+    def read_exact(self, size):
+        chunks = []
+        length = 0
+        while length < size:
+            chunk = self.read_chunk()
+            if not chunk:
+                raise ValueError("truncated ZIP file")
+            chunks.append(chunk)
+            length += len(chunk)
+        data = b''.join(chunks)
+        self.unread(data[size:])
+        return data[:size]
+
+    def skip(self, size):
+        # discards the next size bytes, without keeping them in memory
+        while size > 0:
+            chunk = self.read_chunk()
+            if not chunk:
+                raise ValueError("truncated ZIP file")
+            if len(chunk) > size:
+                self.unread(chunk[size:])
+            size -= len(chunk)
+
+
+
+def too_big(max_size):
+    return f"file too big (more than {max_size // (1024 * 1024)} MB)"
+
+
+
+def read_stored_until_descriptor(reader, max_size):
+    ''' Returns the data of a stored member of unknown size (written by a streaming zip tool)
+
+    The data ends at the first data descriptor whose size and CRC match the bytes before it.
+    Raises ValueError if no descriptor is found within max_size bytes: the end can't be found otherwise.
+    '''
+    signature = struct.pack('<I', DATA_DESCRIPTOR)
+    data = bytearray()
+    search_from = 0
+    while True:
+        chunk = reader.read_chunk()
+        if not chunk:
+            raise ValueError("truncated ZIP file")
+        data += chunk
+        index = data.find(signature, search_from)
+        while index != -1:
+            if index + 12 > len(data):
+                # descriptor not complete yet, check it again with the next chunk
+                break
+            crc, compressed_size = struct.unpack('<II', data[index+4:index+12])
+            if compressed_size == index and zlib.crc32(data[:index]) == crc:
+                # the descriptor is read again by the caller
+                reader.unread(bytes(data[index:]))
+                return bytes(data[:index])
+            index = data.find(signature, index + 1)
+        if len(data) > max_size + 12:
+            raise ValueError(too_big(max_size) + ", ZIP files without sizes are refused")
+        search_from = index if index != -1 else max(0, len(data) - 3)
+
+
+
+def read_member_data(reader, method, compressed_size, has_descriptor, max_size):
+    ''' Returns (data, inflated bytes), data is None if the member is larger than max_size
+
+    At most max_size + 1 bytes are inflated: the rest of a larger member is skipped without inflating it,
+    or the archive is refused (ValueError) when the compressed size is unknown (data descriptor).
+    '''
+    if method == STORED:
+        if has_descriptor:
+            data = read_stored_until_descriptor(reader, max_size)
+            return data, len(data)
+        if compressed_size > max_size:
+            reader.skip(compressed_size)
+            return None, 0
+        return reader.read_exact(compressed_size), compressed_size
+
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    output = []
+    size = 0
+    remaining = None if has_descriptor else compressed_size
+    while not decompressor.eof:
+        # input left over by the previous call first, then the next chunk of the member
+        chunk = decompressor.unconsumed_tail
+        if not chunk:
+            if remaining is None:
+                # size unknown (data descriptor): the end is found by the decompressor
+                chunk = reader.read_chunk()
+            elif remaining:
+                chunk = reader.read_exact(min(remaining, 64 * 1024))
+                remaining -= len(chunk)
+            if not chunk:
+                raise ValueError("truncated ZIP file")
+        data = decompressor.decompress(chunk, max_size - size + 1)
+        size += len(data)
+        if size > max_size:
+            if remaining is None:
+                raise ValueError(too_big(max_size) + ", ZIP files without sizes are refused")
+            reader.skip(remaining)
+            return None, size
+        output.append(data)
+        # inflating is CPU bound: let the other greenlets (race timing included) run between chunks
+        gevent.sleep(0)
+    reader.unread(decompressor.unused_data)
+    return b''.join(output), size
+
+
+
+def iter_zip_members(reader, max_member_size=MAX_MEMBER_SIZE, max_inflated_size=MAX_INFLATED_SIZE):
+    ''' Yields (name, data, error) for each file of a zip archive read by a StreamReader
+
+    The local headers are used, so members are available as soon as they are received and the
+    stream doesn't need to be seekable. Raises ValueError if the stream is not a valid zip.
+    '''
+    inflated = 0
+    while True:
+        signature, = struct.unpack('<I', reader.read_exact(4))
+        if signature in [CENTRAL_DIRECTORY, END_OF_CENTRAL_DIRECTORY]:
+            # all the files have been read
+            return
+        if signature != LOCAL_FILE_HEADER:
+            raise ValueError("file is not a valid ZIP")
+
+        (version, flags, method, mtime, mdate, crc, compressed_size, size,
+         name_length, extra_length) = struct.unpack('<HHHHHIIIHH', reader.read_exact(26))
+        name = reader.read_exact(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = reader.read_exact(extra_length)
+        has_descriptor = bool(flags & 0x08)
+
+        zip64 = compressed_size == 0xFFFFFFFF or size == 0xFFFFFFFF
+        if zip64:
+            # sizes are in the zip64 extra field
+            offset = 0
+            while offset + 4 <= len(extra):
+                field_id, field_size = struct.unpack('<HH', extra[offset:offset+4])
+                if field_id == 0x0001 and field_size >= 16:
+                    size, compressed_size = struct.unpack('<QQ', extra[offset+4:offset+20])
+                offset += 4 + field_size
+
+        error = None
+        if flags & 0x01:
+            raise ValueError("encrypted ZIP files are not supported")
+        if method not in [STORED, DEFLATED]:
+            if has_descriptor:
+                raise ValueError(f"compression method {method} is not supported")
+            reader.skip(compressed_size)
+            data, error = None, f"compression method {method} is not supported"
+        else:
+            data, size = read_member_data(reader, method, compressed_size, has_descriptor, max_member_size)
+            inflated += size
+            if inflated > max_inflated_size:
+                raise ValueError(f"ZIP file too big once extracted (more than {max_inflated_size // (1024 * 1024)} MB)")
+            if data is None:
+                error = too_big(max_member_size)
+
+        if has_descriptor:
+            descriptor = reader.read_exact(4)
+            if struct.unpack('<I', descriptor)[0] == DATA_DESCRIPTOR:
+                descriptor = reader.read_exact(4)
+            crc, = struct.unpack('<I', descriptor)
+            reader.read_exact(16 if zip64 else 8)
+
+        if data is not None and zlib.crc32(data) != crc:
+            data, error = None, "corrupted file (CRC mismatch)"
+
+        yield name, data, error
+
+
+
+class ZipImport():
+    ''' Imports the images of a zip archive as avatars, while the archive is received
+
+    - members accepted by accept_fn(name) are handed to `ingest` (an ImageIngest) as soon as they are read,
+      images are resized in a pool of native threads
+    - progress_fn(progress) is called while the import runs, at most every `progress_interval` seconds
+    - run() returns the status of each file: saved, unchanged, skipped (not an image) or error
+    '''
+
+    def __init__(self, ingest, accept_fn, progress_fn=None, workers=IMPORT_WORKERS, progress_interval=0.25,
+                 max_member_size=MAX_MEMBER_SIZE, max_archive_size=MAX_ARCHIVE_SIZE):
+        self._ingest = ingest
+        self._accept_fn = accept_fn
+        self._max_member_size = max_member_size
+        self._max_archive_size = max_archive_size
+        self._progress_fn = progress_fn
+        self._workers = workers
+        self._progress_interval = progress_interval
+        self._last_progress = 0
+
+    def _progress(self, files, done, reader_bytes, total_bytes, force=False):
+        if not self._progress_fn:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_progress < self._progress_interval:
+            return
+        self._last_progress = now
+        try:
+            self._progress_fn({
+                'received': reader_bytes,
+                'total': total_bytes,
+                'files': len(files),
+                'done': done
+            })
+        except Exception as e:
+            logger.warning(f"Unable to report import progress ({e})")
+
+    def run(self, stream, total_bytes=None):
+        start = time.perf_counter()
+        threadpool = gevent.threadpool.ThreadPool(self._workers)
+        # members in flight are bounded, so a fast upload doesn't fill the memory
+        group = gevent.pool.Pool(self._workers * 2)
+        files = []
+        done = 0
+        reader = StreamReader(stream, self._max_archive_size)
+        error = None
+
+        def ingest(entry, data):
+            nonlocal done
+            try:
+                result = self._ingest.ingest(data, entry['file'].rsplit(".", 1)[0], entry['file'], run=threadpool.apply)
+                entry['status'] = result['status']
+            except Exception as e:
+                if not isinstance(e, ValueError):
+                    logger.error(f"Unable to import {entry['file']} ({e})")
+                entry.update(status='error', error=str(e))
+            done += 1
+            self._progress(files, done, reader.bytes_read, total_bytes)
+
+        try:
+            for name, data, member_error in iter_zip_members(reader, self._max_member_size):
+                if name.endswith('/'):
+                    # folder entry
+                    continue
+                entry = {'file': name}
+                files.append(entry)
+                if os.path.basename(name) != name:
+                    # avoid path traversal such as "../../"
+                    entry.update(status='skipped', error="subfolders or invalid paths")
+                elif member_error:
+                    entry.update(status='error', error=member_error)
+                elif not self._accept_fn(name):
+                    entry.update(status='skipped', error="not an image")
+                else:
+                    group.spawn(ingest, entry, data)
+                    continue
+                done += 1
+                self._progress(files, done, reader.bytes_read, total_bytes)
+        except ValueError as e:
+            error = str(e)
+        finally:
+            group.join()
+            threadpool.kill()
+            # once per archive, not once per image
+            self._ingest.save_hashes()
+
+        self._progress(files, done, reader.bytes_read, total_bytes, force=True)
+
+        counts = dict()
+        for entry in files:
+            counts[entry['status']] = counts.get(entry['status'], 0) + 1
+        return {
+            'error': error,
+            'files': files,
+            'counts': counts,
+            'elapsed_ms': round((time.perf_counter() - start) * 1000)
+        }
+
@@ -0,0 +1,74 @@
+''' Coalesce bursts of RotorHazard events into a single call '''
+
+import logging
+import time
+import gevent
+
+logger = logging.getLogger(__name__)
+
+
+
+class Debouncer():
+    ''' Calls fn once, with the latest arguments, after `wait` seconds without new calls
+
+    A call is never delayed more than `max_wait` seconds after the first call of a burst,
+    so a long stream of events still refreshes the UI from time to time.
+    '''
+
+    def __init__(self, name, fn, wait=0.5, max_wait=3.0):
+        self.name = name
+        # event handlers are identified by name
+        self.__name__ = f"csi_toolkit_debounce_{name}"
+        self._fn = fn
+        self._wait = wait
+        self._max_wait = max_wait
+        self._greenlet = None
+        self._args = None
+        self._deadline = None
+        self.calls = 0
+        self.runs = 0
+
+    def __call__(self, *args):
+        self.calls += 1
+        self._args = args
+
+        now = time.monotonic()
+        if self._deadline is None:
+            self._deadline = now + self._max_wait
+        delay = max(0, min(self._wait, self._deadline - now))
+
+        if self._greenlet:
+            self._greenlet.kill(block=False)
+        self._greenlet = gevent.spawn_later(delay, self._run)
+
+    def _run(self):
+        args = self._args
+        self._greenlet = None
+        self._args = None
+        self._deadline = None
+        self.runs += 1
+        try:
+            self._fn(*args)
+        except Exception as e:
+            logger.error(f"Debounced call {self.name} failed: {e}")
+
+    def flush(self):
+        # run the pending call now, if any
+        if self._greenlet:
+            self._greenlet.kill(block=False)
+            self._run()
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'runs': self.runs,
+            'pending': self._greenlet is not None
+        }
+
+
+
+def debounced(bus, name, fn, wait=0.5, max_wait=3.0):
+    ''' Create a Debouncer and expose its counters in the cache bus stats '''
+    debouncer = Debouncer(name, fn, wait, max_wait)
+    bus.add_stats_provider(f"debounce_{name}", debouncer.stats)
+    return debouncer
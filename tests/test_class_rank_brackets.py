@@ -0,0 +1,40 @@
+''' Tests of the bracket format selection of the ranking method '''
+
+import pytest
+
+# the ranking method imports RotorHazard modules: run with the RotorHazard server folder in the path
+for module in ['RHUtils', 'RHRace', 'Results', 'RHUI', 'eventmanager']:
+    pytest.importorskip(module)
+
+from csi_toolkit.class_rank_brackets.class_rank_brackets import FAI, MULTIGP, CSI, get_ranking_format
+
+
+
+@pytest.mark.parametrize('bracket_type, generated_format, expected', [
+    (MULTIGP, 'multigp16', 'multigp16'),
+    (FAI, 'fai16de', 'fai16de'),
+    # ranked with another bracket type than the generated one: same format by number of heats
+    (FAI, 'multigp16', 'fai16de'),
+    (MULTIGP, 'fai16de', 'multigp16'),
+    (CSI, 'fai16de', 'multigp16'),
+])
+def test_ranking_format_of_generated_class(bracket_type, generated_format, expected):
+    ranking_format = get_ranking_format(bracket_type, 14, {'format': generated_format})
+    assert ranking_format['format'] == expected
+
+
+
+@pytest.mark.parametrize('bracket_type, number_of_heats, expected', [
+    (MULTIGP, 14, 'multigp16'),
+    (FAI, 14, 'fai16de'),
+    (FAI, 8, 'fai16'),
+    (MULTIGP, 6, 'ddr8de'),
+])
+def test_ranking_format_without_metadata(bracket_type, number_of_heats, expected):
+    assert get_ranking_format(bracket_type, number_of_heats)['format'] == expected
+
+
+
+def test_unsupported_format():
+    assert get_ranking_format(MULTIGP, 5) is None
+    assert get_ranking_format(MULTIGP, 5, {'format': 'fai32'}) is None
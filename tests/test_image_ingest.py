@@ -0,0 +1,32 @@
+''' Tests of the file names of uploaded images '''
+
+import os
+import pytest
+
+from csi_toolkit.ddr_overlays.image_ingest import ImageIngest, normalized_name, AVATAR_SIZE
+
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('Pilot One', 'pilot_one'),
+    (' Pilot ', 'pilot'),
+    ('A/B', 'a_b'),
+    ('A\\B', 'a_b'),
+])
+def test_normalized_name(name, expected):
+    assert normalized_name(name) == expected
+
+
+
+@pytest.mark.parametrize('name', ['', ' ', '.', '..', '../../avatar', '.ingest_hashes'])
+def test_invalid_names(tmp_path, name):
+    ingest = ImageIngest(str(tmp_path), AVATAR_SIZE, crop=True)
+    with pytest.raises(ValueError, match="invalid name"):
+        ingest.target(name, name + '.png')
+
+
+
+def test_target_stays_in_folder(tmp_path):
+    ingest = ImageIngest(str(tmp_path), AVATAR_SIZE, crop=True)
+    target, _ = ingest.target('Pilot/../One', 'upload.png')
+    assert os.path.dirname(ingest.path(target)) == os.path.realpath(str(tmp_path))
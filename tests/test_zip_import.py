@@ -0,0 +1,137 @@
+''' Tests of the streaming zip parser of the avatar import '''
+
+import io
+import time
+import zipfile
+import pytest
+
+from csi_toolkit.ddr_overlays.zip_import import StreamReader, iter_zip_members
+
+MB = 1024 * 1024
+
+
+
+class UnseekableWriter(io.RawIOBase):
+    # zipfile writes data descriptors when the output can't be seeked, like streaming zip tools
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+
+def make_zip(members, method=zipfile.ZIP_DEFLATED, streamed=False, force_zip64=False):
+    output = UnseekableWriter() if streamed else io.BytesIO()
+    with zipfile.ZipFile(output, 'w', method) as archive:
+        for name, data in members:
+            with archive.open(name, 'w', force_zip64=force_zip64) as member:
+                member.write(data)
+    return (output.buffer if streamed else output).getvalue()
+
+
+
+def read_members(data, chunk_size=64 * 1024, **kwargs):
+    reader = StreamReader(io.BytesIO(data), chunk_size=chunk_size)
+    return list(iter_zip_members(reader, **kwargs))
+
+
+
+MEMBERS = [
+    ('first.png', b'first image ' * 1000),
+    ('empty.png', b''),
+    # data descriptor signatures inside the data must not end a stored member
+    ('second.jpg', b'PK\x07\x08' * 5000 + bytes(range(256)) * 40),
+]
+
+
+@pytest.mark.parametrize('method', [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+@pytest.mark.parametrize('streamed', [False, True])
+@pytest.mark.parametrize('force_zip64', [False, True])
+def test_members(method, streamed, force_zip64):
+    data = make_zip(MEMBERS, method, streamed, force_zip64)
+    assert read_members(data) == [(name, content, None) for name, content in MEMBERS]
+
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+def test_small_chunks(chunk_size):
+    data = make_zip(MEMBERS, zipfile.ZIP_STORED, streamed=True)
+    assert read_members(data, chunk_size) == [(name, content, None) for name, content in MEMBERS]
+
+
+
+def test_folders_and_paths():
+    data = make_zip([('avatars/', b''), ('avatars/a.png', b'a'), ('../b.png', b'b')])
+    assert [name for name, _, _ in read_members(data)] == ['avatars/', 'avatars/a.png', '../b.png']
+
+
+
+@pytest.mark.parametrize('streamed', [False, True])
+def test_truncated(streamed):
+    data = make_zip(MEMBERS, streamed=streamed)
+    for size in [10, 40, len(data) // 2]:
+        with pytest.raises(ValueError, match="truncated"):
+            read_members(data[:size])
+
+
+
+def test_not_a_zip():
+    with pytest.raises(ValueError, match="not a valid ZIP"):
+        read_members(b'not a zip file at all')
+
+
+
+def test_crc_mismatch():
+    data = bytearray(make_zip([('a.png', b'a' * 100)], zipfile.ZIP_STORED))
+    data[data.index(b'a' * 100)] = ord('b')
+    (name, content, error), = read_members(bytes(data))
+    assert content is None and "CRC" in error
+
+
+
+def test_archive_too_big():
+    data = make_zip(MEMBERS)
+    reader = StreamReader(io.BytesIO(data), max_bytes=len(data) // 2, chunk_size=1024)
+    with pytest.raises(ValueError, match="too big"):
+        list(iter_zip_members(reader))
+
+
+
+@pytest.mark.parametrize('method', [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_member_too_big(method):
+    # a larger member is reported, the next ones are still read
+    data = make_zip([('big.png', b'\0' * (2 * MB)), ('small.png', b'small')], method)
+    (big_name, big, big_error), small = read_members(data, max_member_size=MB)
+    assert big is None and "too big" in big_error
+    assert small == ('small.png', b'small', None)
+
+
+
+def test_bomb():
+    # 256 MB of zeros in a 256 KB zip: only max_member_size + 1 bytes of each member are inflated
+    data = make_zip([(f'bomb{i}.png', b'\0' * (32 * MB)) for i in range(8)] + [('small.png', b'small')])
+    start = time.process_time()
+    members = read_members(data, max_member_size=MB)
+    assert time.process_time() - start < 1
+    assert [error is not None for _, _, error in members] == [True] * 8 + [False]
+
+
+
+def test_bomb_without_sizes():
+    # with a data descriptor the end of a larger member is unknown: the archive is refused
+    data = make_zip([('bomb.png', b'\0' * (64 * MB))], streamed=True)
+    start = time.process_time()
+    with pytest.raises(ValueError, match="too big"):
+        read_members(data, max_member_size=MB)
+    assert time.process_time() - start < 1
+
+
+
+def test_inflated_size_limit():
+    data = make_zip([(f'{i}.png', b'\0' * MB) for i in range(5)])
+    with pytest.raises(ValueError, match="once extracted"):
+        read_members(data, max_member_size=2 * MB, max_inflated_size=3 * MB)